@@ -0,0 +1,59 @@
+# bench/cold_start.py
+# قياس زمن الإقلاع البارد لعامل جديد: استيراد server وبناء التطبيق في عملية جديدة في كل مرة.
+#
+#   python bench/cold_start.py --runs 20
+#   python bench/cold_start.py --top 15       # أثقل الوحدات المستوردة (python -X importtime)
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_STMT = 'import server; server.create_app()'
+
+def run_once(stmt, cwd, env, extra=()):
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, *extra, '-c', stmt], cwd=cwd, env=env,
+                          capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if proc.returncode != 0:
+        raise SystemExit(proc.stderr)
+    return elapsed, proc.stderr
+
+def top_imports(stderr, n):
+    # "import time: self [us] | cumulative | imported package" -> modules imported by the
+    # interpreter or directly by server.py, by cumulative time
+    rows = []
+    for line in stderr.splitlines():
+        parts = line.split('|')
+        if not line.startswith('import time:') or len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        depth = (len(parts[2]) - len(parts[2].lstrip()) - 1) // 2
+        if depth <= 1:
+            rows.append((int(parts[1]), parts[2].strip()))
+    return sorted(rows, reverse=True)[:n]
+
+def main():
+    parser = argparse.ArgumentParser(description='Time a fresh worker importing server and building the app')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--stmt', default=DEFAULT_STMT, help='code to time in a fresh interpreter')
+    parser.add_argument('--cwd', default=ROOT, help='directory holding server.py')
+    parser.add_argument('--top', type=int, default=0, help='also list the N slowest imports')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='cold_start_')
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'cold.db')}")
+    run_once(args.stmt, args.cwd, env)  # warm the OS page cache and .pyc files
+    times = [run_once(args.stmt, args.cwd, env)[0] for _ in range(args.runs)]
+    print(f"{args.stmt!r} x{args.runs}: median {statistics.median(times) * 1000:.0f}ms, "
+          f"min {min(times) * 1000:.0f}ms, max {max(times) * 1000:.0f}ms")
+    if args.top:
+        _, stderr = run_once(args.stmt, args.cwd, env, extra=('-X', 'importtime'))
+        for cumulative, name in top_imports(stderr, args.top):
+            print(f"{cumulative / 1000:8.1f}ms  {name}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# bench/generate_data.py
+# توليد بيانات اصطناعية (مستخدمون ومشتريات) لقاعدة budget.db بتوزيعات واقعية للفئات والتواريخ.
+#
+#   python bench/generate_data.py --db /tmp/bench.db --users 1000 --purchases 200 --days 365
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCH_PASSWORD = 'bench'
+
+# (category, weight, median price in DZD, item names)
+CATEGORIES = [
+    ('food', 35, 600, ['خبز', 'حليب', 'خضر', 'لحم', 'قهوة', 'groceries']),
+    ('transport', 15, 250, ['bus', 'taxi', 'essence', 'metro']),
+    ('shopping', 12, 2500, ['vêtements', 'chaussures', 'électroménager']),
+    ('leisure', 10, 1200, ['cinéma', 'restaurant', 'café']),
+    ('bills', 10, 3500, ['كهرباء', 'ماء', 'internet', 'téléphone']),
+    ('pharmacy', 8, 900, ['doliprane', 'vitamines', 'pansements']),
+    ('', 10, 500, ['divers']),
+]
+
+def load_server(db_url):
+    os.environ['DATABASE_URL'] = db_url
+    sys.path.insert(0, ROOT)
+    import server
+    return server
+
+def random_purchase(rng, user_id, now, days):
+    category, _, median, items = rng.choices(CATEGORIES, weights=[c[1] for c in CATEGORIES])[0]
+    # more recent days are busier; weekends a bit more than weekdays
+    age = min(int(rng.expovariate(3.0 / days)), days - 1)
+    day = now - timedelta(days=age)
+    if day.weekday() >= 4 and rng.random() < 0.3:
+        day -= timedelta(days=1)
+    dt = day.replace(hour=rng.randint(7, 22), minute=rng.randint(0, 59), second=0, microsecond=0)
+    price = round(median * math.exp(rng.gauss(0, 0.6)), 2)
+    return {'user_id': user_id, 'item_name': rng.choice(items), 'price_dz': price,
+            'category': category or None, 'date': dt}
+
+def generate(server, users=100, purchases=100, days=365, seed=42, chunk=5000):
+    """Insert `users` users with ~`purchases` purchases each; returns the new user ids."""
+    rng = random.Random(seed)
+    db = server.db
+    now = datetime.utcnow()
+    with server.app.app_context():
+        server.init_db()
+        # one hash for everyone: hashing thousands of passwords would dominate the run
+        password_hash = server.generate_password_hash(BENCH_PASSWORD)
+        first = (db.session.query(db.func.max(server.User.id)).scalar() or 0) + 1
+        user_rows = [{'id': first + i, 'name': f'bench {first + i}', 'email': f'bench{first + i}@example.com',
+                      'password_hash': password_hash, 'balance_dz': 100000.0} for i in range(users)]
+        db.session.execute(db.insert(server.User), user_rows)
+        db.session.execute(db.insert(server.BalanceLedger), [
+            {'user_id': u['id'], 'amount': u['balance_dz'], 'reason': 'opening'} for u in user_rows
+        ])
+        db.session.commit()
+        batch = []
+        spent = {}
+        for u in user_rows:
+            n = max(0, int(rng.gauss(purchases, purchases * 0.3)))
+            for _ in range(n):
+                batch.append(random_purchase(rng, u['id'], now, days))
+            if len(batch) >= chunk:
+                flush_purchases(server, batch, spent)
+                batch = []
+        flush_purchases(server, batch, spent)
+        for user_id, total in spent.items():
+            server.adjust_balance(user_id, -total, 'batch')
+        db.session.commit()
+    return [u['id'] for u in user_rows]
+
+def flush_purchases(server, rows, spent):
+    if not rows:
+        return
+    server.db.session.execute(server.db.insert(server.Purchase), rows)
+    server.apply_to_aggregates(rows)
+    server.db.session.commit()
+    for r in rows:
+        spent[r['user_id']] = spent.get(r['user_id'], 0.0) + r['price_dz']
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill a budget database with synthetic users and purchases')
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(), 'home_budget_bench.db'),
+                        help='SQLite file to fill (outside the repository by default)')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--purchases', type=int, default=100, help='mean purchases per user')
+    parser.add_argument('--days', type=int, default=365, help='history length')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    server = load_server(f"sqlite:///{os.path.abspath(args.db)}")
+    started = datetime.utcnow()
+    ids = generate(server, args.users, args.purchases, args.days, args.seed)
+    with server.app.app_context():
+        count = server.Purchase.query.count()
+    print(f"{len(ids)} users added, {count} purchases in {args.db} ({(datetime.utcnow() - started).total_seconds():.1f}s)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+# bench/run_benchmarks.py
+# قياس أداء المسارات الأساسية ومهمة التقارير على بيانات اصطناعية، مع مقارنة بخط أساس JSON.
+#
+#   python bench/run_benchmarks.py --users 200 --purchases 200 --save-baseline
+#   python bench/run_benchmarks.py --users 200 --purchases 200    # يفشل (exit 1) عند التراجع
+#
+# الرسائل تذهب إلى خادم SMTP محلي (aiosmtpd)، لا إلى خادم حقيقي.
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+SMTP_SINK_PORT = 8025
+
+def start_smtp_sink():
+    # local SMTP sink; returns (controller, list of received envelopes)
+    from aiosmtpd.controller import Controller
+
+    received = []
+
+    class Sink:
+        async def handle_DATA(self, server, session, envelope):
+            received.append(len(envelope.content))
+            return '250 OK'
+
+    controller = Controller(Sink(), hostname='127.0.0.1', port=SMTP_SINK_PORT)
+    controller.start()
+    return controller, received
+
+def configure_env(workdir):
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'REPORT_CACHE_DIR': os.path.join(workdir, 'report_cache'),
+        'SMTP_SERVER': '127.0.0.1',
+        'SMTP_PORT': str(SMTP_SINK_PORT),
+        'SMTP_USE_SSL': '0',
+        'EMAIL_PASSWORD': '',
+    })
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux (bytes on macOS)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+class QueryCounter:
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        self.lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, *args):
+        with self.lock:
+            self.count += 1
+
+def run_scenario(name, app, counter, make_request, requests, concurrency):
+    latencies = []
+    lock = threading.Lock()
+    errors = [0]
+
+    def run(n):
+        client = app.test_client()
+        for _ in range(n):
+            started = time.perf_counter()
+            resp = make_request(client)
+            elapsed = time.perf_counter() - started
+            resp.close()
+            with lock:
+                latencies.append(elapsed)
+                if resp.status_code >= 400:
+                    errors[0] += 1
+
+    queries_before = counter.count
+    per_thread = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    threads = [threading.Thread(target=run, args=(n,)) for n in per_thread]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'throughput_rps': round(len(latencies) / wall, 1) if wall else 0.0,
+        'queries_per_request': round((counter.count - queries_before) / max(len(latencies), 1), 2),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def run_report_job(server, counter, received):
+    queries_before = counter.count
+    sent_before = len(received)
+    started = time.perf_counter()
+    with server.app.app_context():
+        stats = server.make_and_send_reports()
+        delivered = server.deliver_outbox()
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': 1,
+        'errors': stats['failed'] + delivered['retry'] + delivered['failed'],
+        'p50_ms': round(elapsed * 1000, 2),
+        'p95_ms': round(elapsed * 1000, 2),
+        'p99_ms': round(elapsed * 1000, 2),
+        'throughput_rps': round(stats['reports_queued'] / elapsed, 1) if elapsed else 0.0,
+        'queries_per_request': counter.count - queries_before,
+        'peak_rss_mb': peak_rss_mb(),
+        'reports': stats['reports_queued'],
+        'emails_delivered': len(received) - sent_before,
+    }
+
+def run_all(args):
+    workdir = tempfile.mkdtemp(prefix='home_budget_bench_')
+    configure_env(workdir)
+    sys.path.insert(0, os.path.dirname(BENCH_DIR))
+    sys.path.insert(0, BENCH_DIR)
+    import jwt
+    import server
+    import generate_data
+
+    controller, received = start_smtp_sink()
+    try:
+        user_ids = generate_data.generate(server, args.users, args.purchases, args.days, args.seed)
+        with server.app.app_context():
+            counter = QueryCounter(server.db.engine)
+        rng = random.Random(args.seed)
+        tokens = {uid: jwt.encode({'id': uid, 'exp': datetime.utcnow() + timedelta(days=1)},
+                                  server.JWT_SECRET, algorithm='HS256') for uid in user_ids}
+
+        def auth():
+            return {'Authorization': f'Bearer {tokens[rng.choice(user_ids)]}'}
+
+        month_ago = (date.today() - timedelta(days=30)).isoformat()
+        scenarios = {
+            'login': lambda c: c.post('/login', json={
+                'email': f'bench{rng.choice(user_ids)}@example.com', 'password': generate_data.BENCH_PASSWORD}),
+            'add_purchase': lambda c: c.post('/add_purchase', headers=auth(), json={
+                'item_name': 'bench', 'price_dz': 100, 'category': 'food'}),
+            'purchases_page': lambda c: c.get('/purchases?limit=100', headers=auth()),
+            'purchases_month': lambda c: c.get(f'/purchases?start={month_ago}', headers=auth()),
+            'generate_report': lambda c: c.post('/generate_report', headers=auth(), json={'type': 'monthly'}),
+        }
+        results = {}
+        for name, make_request in scenarios.items():
+            if args.only and name not in args.only:
+                continue
+            n = args.login_requests if name == 'login' else args.requests
+            results[name] = run_scenario(name, server.app, counter, make_request, n, args.concurrency)
+            print_row(name, results[name])
+        if not args.only or 'make_and_send_reports' in args.only:
+            results['make_and_send_reports'] = run_report_job(server, counter, received)
+            print_row('make_and_send_reports', results['make_and_send_reports'])
+    finally:
+        controller.stop()
+    return {
+        'meta': {
+            'created_at': datetime.utcnow().isoformat(),
+            'users': args.users, 'purchases_per_user': args.purchases, 'days': args.days,
+            'requests': args.requests, 'concurrency': args.concurrency, 'seed': args.seed,
+        },
+        'results': results,
+    }
+
+def print_row(name, r):
+    print(f"{name:<24}{r['requests']:>7}{r['errors']:>7}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}"
+          f"{r['throughput_rps']:>10}{r['queries_per_request']:>8}{r['peak_rss_mb']:>9}")
+
+def compare(current, baseline, tolerance):
+    # [(scenario, metric, baseline, current)] that got worse than the tolerance allows
+    regressions = []
+    for name, r in current['results'].items():
+        b = baseline.get('results', {}).get(name)
+        if not b:
+            continue
+        for metric in ('p95_ms', 'p99_ms'):
+            if b[metric] and r[metric] > b[metric] * (1 + tolerance):
+                regressions.append((name, metric, b[metric], r[metric]))
+        if b['throughput_rps'] and r['throughput_rps'] < b['throughput_rps'] * (1 - tolerance):
+            regressions.append((name, 'throughput_rps', b['throughput_rps'], r['throughput_rps']))
+        if r['queries_per_request'] > b['queries_per_request'] + 0.1:
+            regressions.append((name, 'queries_per_request', b['queries_per_request'], r['queries_per_request']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the budget API routes and the report job')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--purchases', type=int, default=200, help='mean purchases per user')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--requests', type=int, default=300, help='requests per route')
+    parser.add_argument('--login-requests', type=int, default=30, help='requests for /login (slow KDF)')
+    parser.add_argument('--concurrency', type=int, default=4, help='client threads')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--only', nargs='*', help='scenarios to run')
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown')
+    args = parser.parse_args()
+
+    print(f"{'scenario':<24}{'reqs':>7}{'errs':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'req/s':>10}{'q/req':>8}{'rss MB':>9}")
+    current = run_all(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(current, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print("no baseline to compare with (use --save-baseline)")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(current, baseline, args.tolerance)
+    for name, metric, before, after in regressions:
+        print(f"REGRESSION {name} {metric}: {before} -> {after}")
+    if regressions:
+        sys.exit(1)
+    print("no regressions")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# bench/search_benchmark.py
+# مقارنة البحث عبر فهرس FTS5 (purchase_fts) مع مسح LIKE '%...%' على جدول مشتريات اصطناعي كبير.
+#
+#   python bench/search_benchmark.py --rows 10000000 --users 10000
+#   python bench/search_benchmark.py --db /tmp/search.db --reuse     # إعادة القياس على قاعدة موجودة
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import server
+from generate_data import CATEGORIES
+
+LIMIT = 100
+
+def create_schema(path):
+    # the real schema (tables, indexes, FTS table and triggers) from server.init_db()
+    app = server.create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{path}"})
+    with app.app_context():
+        server.init_db()
+        server.db.engine.dispose()
+    return server.PURCHASE_FTS_SCHEMA
+
+def brand_words(rng, n):
+    # extra words appended to item names, so searches range from common to rare terms
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return sorted({''.join(rng.choice(letters) for _ in range(6)) for _ in range(n)})
+
+def fill(path, rows, users, days, seed, chunk=100000):
+    rng = random.Random(seed)
+    fts_schema = create_schema(path)
+    brands = brand_words(rng, 5000)
+    weights = [c[1] for c in CATEGORIES]
+    now = datetime(2025, 1, 1)
+    con = sqlite3.connect(path)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('PRAGMA synchronous=OFF')
+    # bulk load without the per-row FTS trigger, then build the index in one pass
+    con.execute('DROP TRIGGER IF EXISTS purchase_fts_ai')
+    started = time.perf_counter()
+    done = 0
+    while done < rows:
+        batch = []
+        for _ in range(min(chunk, rows - done)):
+            category, _, median, items = rng.choices(CATEGORIES, weights=weights)[0]
+            dt = now - timedelta(days=rng.randrange(days), minutes=rng.randrange(1440))
+            batch.append((rng.randrange(1, users + 1), f"{rng.choice(items)} {rng.choice(brands)}",
+                           round(median * rng.uniform(0.5, 1.5), 2), category or None, dt.isoformat(' ')))
+        con.executemany('INSERT INTO purchase (user_id, item_name, price_dz, category, date) VALUES (?, ?, ?, ?, ?)', batch)
+        con.commit()
+        done += len(batch)
+        print(f"\r{done} rows", end='', flush=True)
+    print(f" loaded in {time.perf_counter() - started:.0f}s")
+    started = time.perf_counter()
+    con.execute("INSERT INTO purchase_fts (rowid, item_name, category, owner) "
+                "SELECT id, item_name, coalesce(category, ''), 'u' || user_id FROM purchase")
+    for stmt in fts_schema:
+        con.execute(stmt)
+    con.commit()
+    print(f"FTS index built in {time.perf_counter() - started:.0f}s")
+    con.close()
+    return brands
+
+def timed(con, sql, params, runs):
+    times, n = [], 0
+    for p in params[:runs]:
+        started = time.perf_counter()
+        n += len(con.execute(sql, p).fetchall())
+        times.append(time.perf_counter() - started)
+    return statistics.median(times) * 1000, max(times) * 1000, n / max(len(times), 1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark FTS5 search against a LIKE scan')
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(), 'home_budget_search.db'))
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--runs', type=int, default=50, help='queries per case')
+    parser.add_argument('--reuse', action='store_true', help='benchmark an existing --db without refilling it')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.reuse:
+        brands = brand_words(rng, 5000)
+    else:
+        if os.path.exists(args.db):
+            os.remove(args.db)
+        brands = fill(args.db, args.rows, args.users, args.days, args.seed)
+    con = sqlite3.connect(args.db)
+    total = con.execute('SELECT count(*) FROM purchase').fetchone()[0]
+    users = con.execute('SELECT max(user_id) FROM purchase').fetchone()[0]
+    print(f"{total} purchases, {users} users, {os.path.getsize(args.db) / 1e6:.0f} MB")
+
+    cases = {'common word': ['doliprane', 'taxi', 'restaurant', 'internet'], 'rare word': brands}
+    like_user = (f'SELECT id FROM purchase WHERE user_id = ? AND (item_name LIKE ? OR category LIKE ?) '
+                 f'ORDER BY date DESC, id DESC LIMIT {LIMIT}')
+    like_all = f'SELECT id FROM purchase WHERE item_name LIKE ? OR category LIKE ? LIMIT {LIMIT}'
+    fts_user = (f"SELECT p.id FROM purchase p WHERE p.id IN (SELECT rowid FROM purchase_fts WHERE purchase_fts MATCH ?) "
+                f"AND p.user_id = ? ORDER BY p.date DESC, p.id DESC LIMIT {LIMIT}")
+    fts_all = f'SELECT rowid FROM purchase_fts WHERE purchase_fts MATCH ? LIMIT {LIMIT}'
+    print(f"{'case':<34}{'median ms':>10}{'max ms':>10}{'rows':>8}")
+    for label, words in cases.items():
+        picks = [(rng.randrange(1, users + 1), rng.choice(words)) for _ in range(args.runs)]
+        rows = [
+            ('LIKE, one user', like_user, [(u, f'%{w}%', f'%{w}%') for u, w in picks], args.runs),
+            ('FTS5, one user', fts_user, [(server.fts_match(w, u), u) for u, w in picks], args.runs),
+            # a table-wide LIKE reads every row when the word is rare; a few runs are enough
+            ('LIKE, whole table', like_all, [(f'%{w}%', f'%{w}%') for _, w in picks], min(args.runs, 5)),
+            ('FTS5, whole table', fts_all, [(f'{{item_name category}} : ("{w}")',) for _, w in picks], args.runs),
+        ]
+        for name, sql, params, runs in rows:
+            median, worst, found = timed(con, sql, params, runs)
+            print(f"{label + ' / ' + name:<34}{median:>10.2f}{worst:>10.2f}{found:>8.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# bench/write_throughput.py
+# قياس معدل الكتابة (/add_purchase) مع عدة عمليات وخيوط على نفس ملف SQLite،
+# قبل ضبط SQLite (الإعداد الافتراضي) وبعده (WAL + busy_timeout + طابور الكتابة)، ومع التقسيم على عدة ملفات (SHARDS).
+# كل خيط يكتب لمستخدم مختلف، حتى تتوزع الكتابات على الشاردات.
+#
+#   python bench/write_throughput.py --workers 4 --threads 4 --requests 200
+#   python bench/write_throughput.py --configs wal,wal+shards --shards 8
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIGS = {
+    'before': {'SQLITE_TUNING': '0', 'WRITE_QUEUE': '0'},
+    'wal': {'SQLITE_TUNING': '1', 'WRITE_QUEUE': '0'},
+    'wal+queue': {'SQLITE_TUNING': '1', 'WRITE_QUEUE': '1'},
+    'wal+shards': {'SQLITE_TUNING': '1', 'WRITE_QUEUE': '0', 'SHARDS': '4'},
+    'wal+queue+shards': {'SQLITE_TUNING': '1', 'WRITE_QUEUE': '1', 'SHARDS': '4'},
+}
+
+def load_server(env):
+    os.environ.update(env)
+    sys.path.insert(0, ROOT)
+    import server
+    return server
+
+def setup(env, users):
+    server = load_server(env)
+    with server.app.app_context():
+        server.init_db()
+    client = server.app.test_client()
+    tokens = []
+    for i in range(users):
+        email = f'bench{i}@example.com'
+        client.post('/register', json={'email': email, 'password': 'bench', 'balance_dz': 0})
+        tokens.append(client.post('/login', json={'email': email, 'password': 'bench'}).json['token'])
+    return tokens
+
+def worker(env, tokens, requests, out):
+    server = load_server(env)
+    codes = {}
+    lock = threading.Lock()
+
+    def run(token):
+        client = server.app.test_client()
+        headers = {'Authorization': f'Bearer {token}'}
+        for i in range(requests):
+            status = client.post('/add_purchase', headers=headers,
+                                 json={'item_name': f'bench {i}', 'price_dz': 1, 'category': 'bench'}).status_code
+            with lock:
+                codes[status] = codes.get(status, 0) + 1
+
+    ts = [threading.Thread(target=run, args=(token,)) for token in tokens]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    out.put(codes)
+
+def run_config(name, args):
+    workdir = tempfile.mkdtemp()
+    env = dict(CONFIGS[name], DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    if 'SHARDS' in env:
+        env.update(SHARDS=str(args.shards), SHARD_URL=f"sqlite:///{os.path.join(workdir, 'shard{n}.db')}")
+    ctx = multiprocessing.get_context('spawn')
+    tokens = ctx.Pool(1).apply(setup, (env, args.workers * args.threads))
+    out = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(env, tokens[i::args.workers], args.requests, out))
+             for i in range(args.workers)]
+    started = time.perf_counter()
+    for p in procs:
+        p.start()
+    codes = {}
+    for _ in procs:
+        for status, n in out.get().items():
+            codes[status] = codes.get(status, 0) + n
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - started
+    ok = codes.get(200, 0)
+    return {'config': name, 'ok': ok, 'errors': sum(codes.values()) - ok,
+            'seconds': round(elapsed, 2), 'writes_per_s': round(ok / elapsed, 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite write throughput for /add_purchase')
+    parser.add_argument('--workers', type=int, default=4, help='processes (gunicorn workers)')
+    parser.add_argument('--threads', type=int, default=4, help='threads per process')
+    parser.add_argument('--requests', type=int, default=100, help='requests per thread')
+    parser.add_argument('--shards', type=int, default=4, help='shard count for the *shards configs')
+    parser.add_argument('--configs', default=','.join(CONFIGS))
+    args = parser.parse_args()
+    print(f"{'config':<18}{'ok':>8}{'errors':>8}{'seconds':>10}{'writes/s':>10}")
+    for name in args.configs.split(','):
+        r = run_config(name, args)
+        print(f"{r['config']:<18}{r['ok']:>8}{r['errors']:>8}{r['seconds']:>10}{r['writes_per_s']:>10}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# pdf_report.py
+# رسم تقارير PDF من بيانات بسيطة (tuples) فقط، بدون Flask أو ORM،
+# حتى يمكن تشغيله داخل ProcessPoolExecutor
+import zlib
+from datetime import datetime
+from io import BytesIO
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.rl_accel import escapePDF
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfgen import canvas
+
+# خطوط PDF القياسية فقط؛ الأحرف غير المدعومة تُستبدل كما يفعل ReportLab
+REPORT_FONTS = ('Helvetica', 'Helvetica-Bold', 'Symbol', 'ZapfDingbats')
+
+def report_pages(user_name, user_email, rows, title, total=None):
+    """Lay a report out one page at a time.
+
+    Yields each page as a list of (font, size, x, y, text) and returns the
+    total; only the current page is held in memory.
+    """
+    width, height = A4
+    y = height - 50
+    page = [("Helvetica-Bold", 14, 50, y, title)]
+    y -= 30
+    page.append(("Helvetica", 11, 50, y, f"المستخدم: {user_name} -- الإيميل: {user_email}"))
+    y -= 20
+    page.append(("Helvetica", 11, 50, y, f"تاريخ التوليد: {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}"))
+    y -= 30
+    precomputed = total is not None
+    total = total if precomputed else 0.0
+    page.append(("Helvetica-Bold", 12, 50, y, "التفاصيل:"))
+    y -= 20
+    for day, category, item_name, price_dz in rows:
+        page.append(("Helvetica", 10, 50, y, f"{day} | {category or '-'} | {item_name} | {price_dz:.2f} د.ج"))
+        y -= 15
+        if not precomputed:
+            total += price_dz
+        if y < 80:
+            yield page
+            page, y = [], height - 50
+    y -= 10
+    page.append(("Helvetica-Bold", 12, 50, y, f"الإجمالي: {total:.2f} د.ج"))
+    yield page
+    return total
+
+def _draw_pages(pages, draw_page):
+    # feed every page to draw_page and return the generator's total
+    while True:
+        try:
+            page = next(pages)
+        except StopIteration as done:
+            return done.value
+        draw_page(page)
+
+def render_report_pdf(user_name, user_email, rows, title='تقرير المصاريف', total=None):
+    """Render a purchases report and return (pdf_bytes, total).
+
+    `rows` are (date 'YYYY-MM-DD', category, item_name, price_dz) tuples. If
+    `total` is given (e.g. from DailyCategoryTotal) it is printed as is,
+    otherwise it is summed from the rows.
+    """
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=A4)
+
+    def draw_page(page):
+        for font, size, x, y, text in page:
+            c.setFont(font, size)
+            c.drawString(x, y, text)
+        c.showPage()
+
+    total = _draw_pages(report_pages(user_name, user_email, rows, title, total), draw_page)
+    c.save()
+    return buffer.getvalue(), total
+
+class _PdfWriter:
+    """Write PDF objects to a file as they are produced.
+
+    Only the byte offset of each object is kept, so a document of any length
+    is written in constant memory. Object 1 is the catalog and 2 the page tree;
+    both are written by close() once every page is known.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pos = 0
+        self.offsets = {}
+        self.next_id = 3
+        self.write(b"%PDF-1.4\n%\x93\x8c\x8b\x9e\n")
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.pos += len(data)
+
+    def reserve(self):
+        obj_id, self.next_id = self.next_id, self.next_id + 1
+        return obj_id
+
+    def add(self, body, obj_id=None):
+        obj_id = obj_id or self.reserve()
+        self.offsets[obj_id] = self.pos
+        self.write(b"%d 0 obj\n%s\nendobj\n" % (obj_id, body))
+        return obj_id
+
+    def add_stream(self, data):
+        data = zlib.compress(data)
+        return self.add(b"<< /Filter /FlateDecode /Length %d >>\nstream\n%s\nendstream" % (len(data), data))
+
+    def close(self, page_ids):
+        kids = b" ".join(b"%d 0 R" % i for i in page_ids)
+        self.add(b"<< /Type /Pages /Count %d /Kids [ %s ] >>" % (len(page_ids), kids), 2)
+        self.add(b"<< /Type /Catalog /Pages 2 0 R >>", 1)
+        xref = self.pos
+        size = self.next_id
+        self.write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+        for obj_id in range(1, size):
+            self.write(b"%010d 00000 n \n" % self.offsets[obj_id])
+        self.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref))
+
+def _page_content(page, font_names):
+    # PDF text operators of one page; runs a font cannot encode go to its substitution fonts
+    ops = [b"BT"]
+    for font_name, size, x, y, text in page:
+        font = pdfmetrics.getFont(font_name)
+        ops.append(b"1 0 0 1 %g %g Tm" % (x, y))
+        for f, chunk in pdfmetrics.unicode2T1(text, [font] + font.substitutionFonts):
+            ops.append(b"/%s %g Tf (%s) Tj" % (font_names[f.fontName], size, escapePDF(chunk).encode('latin-1')))
+    ops.append(b"ET")
+    return b"\n".join(ops)
+
+def render_report_to(fileobj, user_name, user_email, rows, title='تقرير المصاريف', total=None):
+    """Render a purchases report into `fileobj` and return the total.
+
+    `rows` may be any iterator (e.g. a server-side DB cursor). Each page is
+    deflated and written as soon as it is full, so peak memory stays flat
+    however many rows there are.
+    """
+    out = _PdfWriter(fileobj)
+    font_names, font_refs = {}, []
+    for n, font_name in enumerate(REPORT_FONTS, 1):
+        encoding = b" /Encoding /WinAnsiEncoding" if pdfmetrics.getFont(font_name).encName == 'WinAnsiEncoding' else b""
+        font_id = out.add(b"<< /Type /Font /Subtype /Type1 /BaseFont /%s%s >>" % (font_name.encode(), encoding))
+        font_names[font_name] = b"F%d" % n
+        font_refs.append(b"/F%d %d 0 R" % (n, font_id))
+    resources = out.add(b"<< /Font << %s >> /ProcSet [ /PDF /Text ] >>" % b" ".join(font_refs))
+    page_ids = []
+    width, height = A4
+
+    def draw_page(page):
+        contents = out.add_stream(_page_content(page, font_names))
+        page_ids.append(out.add(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [ 0 0 %g %g ] /Resources %d 0 R /Contents %d 0 R >>"
+            % (width, height, resources, contents)
+        ))
+
+    total = _draw_pages(report_pages(user_name, user_email, rows, title, total), draw_page)
+    out.close(page_ids)
+    return total
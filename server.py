@@ -1,20 +1,43 @@
 # server.py
 import os
-import smtplib
-from datetime import datetime, timedelta, date
-from email.message import EmailMessage
+import io
+import csv
+import json
+import pickle
+import time
+import zlib
+import heapq
+import base64
+import threading
+import uuid
+import hashlib
+import tempfile
+import socket
+import multiprocessing
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import groupby, islice
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, date, timezone
 from io import BytesIO
-from flask import Flask, request, jsonify, send_file
+from flask import Blueprint, Flask, Response, current_app, g, has_request_context, make_response, request, jsonify, send_file, stream_with_context
+import click
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
+import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 from functools import wraps
-from apscheduler.schedulers.background import BackgroundScheduler
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
+from metrics import Counter, Gauge, Histogram, render_all as render_metrics
 
 # -------------------- Config --------------------
 DATABASE_FILE = 'budget.db'
+DATABASE_URL = os.environ.get('DATABASE_URL', f'sqlite:///{DATABASE_FILE}')
 JWT_SECRET = os.environ.get('JWT_SECRET', 'change_me_please')
 ADMIN_KEY = os.environ.get('ADMIN_KEY', 'Imedoxx123')
 
@@ -23,45 +46,626 @@ EMAIL_ADDRESS = os.environ.get('EMAIL_ADDRESS', 'hhomebudget@gmail.com')
 EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD', 'homebudget123')
 SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
 SMTP_PORT = int(os.environ.get('SMTP_PORT', 465))
+# SMTP_USE_SSL=0 لخادم SMTP محلي للتجارب (aiosmtpd / debugging server)
+SMTP_USE_SSL = os.environ.get('SMTP_USE_SSL', '1') != '0'
+# صندوق الصادر: عدد اتصالات SMTP المتوازية، والرسائل لكل اتصال، وإعادة المحاولة
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', 2))
+SMTP_MESSAGES_PER_CONNECTION = int(os.environ.get('SMTP_MESSAGES_PER_CONNECTION', 50))
+OUTBOX_BATCH_SIZE = 200
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_BACKOFF_SECONDS = 60
+OUTBOX_CLAIM_TIMEOUT = timedelta(minutes=15)
+OUTBOX_POLL_MINUTES = 5
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DATABASE_FILE}'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+# حجم الصفحة الافتراضي والأقصى لـ /purchases
+PURCHASES_PAGE_SIZE = 100
+PURCHASES_MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+# أقصى عدد مشتريات في طلب /add_purchases واحد
+ADD_PURCHASES_MAX_BATCH = 10000
+# استيراد CSV: حجم الدفعة، أقصى حجم للملف، وأقصى عدد أخطاء تُعاد في الرد
+IMPORT_CHUNK_SIZE = 1000
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 100 * 1024 * 1024))
+IMPORT_MAX_ERRORS = 1000
+
+# عدد عمليات رسم تقارير PDF (0 = الرسم في نفس الخيط)
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', 0))
+# أقصى عدد تقارير قيد الرسم في نفس الوقت أثناء مهمة الجدولة
+REPORT_MAX_IN_FLIGHT = max(2 * REPORT_WORKERS, 1)
+_report_pool = None
+_report_pool_lock = threading.Lock()
+
+# كاش ملفات PDF للتقارير على القرص (مشترك بين عمال gunicorn)، مع حذف الأقدم استخداماً
+REPORT_CACHE_DIR = os.environ.get('REPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'home_budget_reports'))
+REPORT_CACHE_MAX_BYTES = int(os.environ.get('REPORT_CACHE_MAX_BYTES', 200 * 1024 * 1024))
+# المجلد يُمسح فقط عندما يتجاوز الحجم المقدَّر الحد أو بعد هذه المدة (العمال الآخرون يكتبون أيضاً)
+REPORT_CACHE_SCAN_SECONDS = int(os.environ.get('REPORT_CACHE_SCAN_SECONDS', 300))
+# فوق هذا العدد من المشتريات يُرسم التقرير مباشرة من المؤشر إلى ملف على القرص
+REPORT_STREAM_THRESHOLD = int(os.environ.get('REPORT_STREAM_THRESHOLD', 5000))
+
+# مهام التقارير غير المتزامنة (POST /reports): عدد الخيوط وحجم الطابور ومدة الاحتفاظ
+REPORT_JOB_WORKERS = int(os.environ.get('REPORT_JOB_WORKERS', 2))
+REPORT_JOB_MAX_QUEUE = int(os.environ.get('REPORT_JOB_MAX_QUEUE', 32))
+REPORT_JOB_RETRY_AFTER = 5
+REPORT_JOB_STALE = timedelta(minutes=15)
+REPORT_JOB_RETENTION = timedelta(days=7)
+
+# كاش التوكنات والمستخدمين داخل كل عملية، حتى لا يكلف التحقق من التوكن استعلاماً
+AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 60))
+AUTH_CACHE_SIZE = 10000
+
+# كاش مصفوفات NumPy لتحليلات المصاريف (عدد المستخدمين المحفوظين في كل عملية)
+ANALYTICS_CACHE_SIZE = int(os.environ.get('ANALYTICS_CACHE_SIZE', 256))
+# أطول فترة (بالأيام) يقبلها /analytics، لأن حجم المصفوفات اليومية يتبع طول الفترة
+ANALYTICS_MAX_DAYS = int(os.environ.get('ANALYTICS_MAX_DAYS', 5 * 366))
+
+# المشتريات الأقدم من هذا العدد من الأشهر تُنقل إلى أرشيف مضغوط (شهر لكل مستخدم)؛ 0 = بلا أرشفة (الافتراضي).
+# تفعيلها اختياري لأن /purchases/search يبحث في الجدول الحي فقط ولا يرى المشتريات المؤرشفة
+ARCHIVE_AFTER_MONTHS = int(os.environ.get('ARCHIVE_AFTER_MONTHS', 0))
+
+# تجزئة كلمات المرور في مجمع خيوط محدود؛ عند امتلاء الطابور يرد الخادم 503
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', 16))
+PASSWORD_HASH_RETRY_AFTER = 2
+
+# ضبط SQLite: WAL و synchronous و busy_timeout لكل اتصال (SQLITE_TUNING=0 للإعدادات الافتراضية)
+SQLITE_TUNING = os.environ.get('SQLITE_TUNING', '1') != '0'
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 10000))
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', 10))
+# طابور كتابة داخل العملية يجمع الالتزامات الصغيرة في commit واحد (اختياري)
+WRITE_QUEUE_ENABLED = os.environ.get('WRITE_QUEUE', '0') == '1'
+WRITE_QUEUE_MAX_BATCH = 64
+WRITE_QUEUE_MAX_DELAY = 0.002
+
+# الجدولة: عملية واحدة فقط (صاحبة عقد الإيجار في قاعدة البيانات) تنفذ المهام
+SCHEDULER_LEASE_TTL = timedelta(seconds=int(os.environ.get('SCHEDULER_LEASE_TTL', 180)))
+SCHEDULER_INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# تسجيل الطلبات البطيئة (بالمللي ثانية)؛ 0 = معطل
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 0))
+
+# create_app(): لا جداول ولا مجدول عند الاستيراد؛ كل شيء يُفعَّل صراحة
+INIT_DB = os.environ.get('INIT_DB', '0') == '1'
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', '0') == '1'
+
+# تقسيم بيانات المستخدمين على عدة ملفات SQLite حسب user_id (0 = قاعدة واحدة)
+SHARD_COUNT = int(os.environ.get('SHARDS', 0))
+SHARD_URL = os.environ.get('SHARD_URL', 'sqlite:///budget_shard{n}.db')
+# مع الشاردات، المعرفات الجديدة في كل قاعدة لها باقٍ خاص بها (mod ID_STRIDE) فلا تتكرر بين القواعد
+# وتنتقل مع المستخدم كما هي؛ لا يتغير بعد بدء الكتابة، ويحدّ عدد الشاردات بـ ID_STRIDE - 1
+ID_STRIDE = 64
+# جداول مشتركة تبقى دائماً في القاعدة الرئيسية
+GLOBAL_TABLES = frozenset({'email_outbox', 'scheduler_lease', 'job_run', 'report_job', 'shard_map'})
+
+# None = the main database, n = shard n; set per request by token_required
+_current_shard = ContextVar('current_shard', default=None)
+
+class ShardedSession(FlaskSession):
+    """Session that sends per-user tables to the shard selected with use_shard().
+
+    Outside a shard scope (or for GLOBAL_TABLES) everything goes to the main
+    database, as with a plain Flask-SQLAlchemy session.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        shard = _current_shard.get()
+        if bind is None and shard is not None and statement_table(mapper, clause) not in GLOBAL_TABLES:
+            return self._db.engines[f'shard{shard}']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def statement_table(mapper, clause):
+    # name of the table a statement is about; None for text() and bare selects
+    if mapper is not None:
+        return sa.inspect(mapper).local_table.name
+    if isinstance(clause, sa.Table):
+        return clause.name
+    if isinstance(clause, sa.sql.dml.UpdateBase) and isinstance(clause.table, sa.Table):
+        return clause.table.name
+    return None
+
+db = SQLAlchemy(session_options={'class_': ShardedSession})
+# routes, hooks and CLI commands; registered on the app by create_app()
+bp = Blueprint('budget', __name__, cli_group=None)
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_conn, connection_record):
+    if not SQLITE_TUNING or not type(dbapi_conn).__module__.startswith('sqlite3'):
+        return
+    cur = dbapi_conn.cursor()
+    cur.execute('PRAGMA journal_mode=WAL')  # readers no longer block the writer
+    cur.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+    cur.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    cur.close()
+
+# -------------------- Metrics --------------------
+# القيم خاصة بكل عملية (كل عامل gunicorn يعرض أرقامه في /metrics)
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Request latency by route',
+                            ('route', 'method', 'status'))
+REQUEST_SQL_QUERIES = Histogram('http_request_sql_queries', 'SQL statements per request', ('route',),
+                                buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+REQUEST_SQL_SECONDS = Histogram('http_request_sql_seconds', 'Time spent in SQL per request', ('route',))
+SQL_SECONDS = Histogram('sql_query_duration_seconds', 'Latency of every SQL statement',
+                        buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0))
+REPORT_RENDER_SECONDS = Histogram('report_render_seconds', 'Time to render a report PDF', ('mode',))
+SMTP_SEND_SECONDS = Histogram('smtp_send_seconds', 'Time to send one email over SMTP', ('path',))
+SMTP_ERRORS = Counter('smtp_errors_total', 'Emails that failed to send', ('path',))
+JOB_SECONDS = Histogram('scheduler_job_duration_seconds', 'Scheduled job duration', ('job',))
+JOB_RUNS = Counter('scheduler_job_runs_total', 'Scheduled job runs by outcome', ('job', 'status'))
+REPORT_JOB_LAST = Gauge('report_job_last_run', 'Counts from the last report job run', ('stat',))
+PASSWORD_POOL = Gauge('password_pool', 'Password hashing pool counters', ('stat',))
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def sql_timer_start(conn, cursor, statement, parameters, context, executemany):
+    # kept on the statement's own context: a failing statement never reaches sql_timer_stop
+    context._query_start = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def sql_timer_stop(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_start
+    SQL_SECONDS.observe(elapsed)
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_seconds += elapsed
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+
+@bp.after_app_request
+def record_request_metrics(response):
+    if 'request_started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUEST_SECONDS.observe(elapsed, route=route, method=request.method, status=response.status_code)
+    REQUEST_SQL_QUERIES.observe(g.sql_queries, route=route)
+    REQUEST_SQL_SECONDS.observe(g.sql_seconds, route=route)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        print(f"Slow request: {request.method} {request.path} {response.status_code} "
+              f"{elapsed * 1000:.0f}ms, {g.sql_queries} queries / {g.sql_seconds * 1000:.0f}ms SQL")
+    return response
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    with _password_stats_lock:
+        for stat, value in password_pool_stats.items():
+            PASSWORD_POOL.set(value, stat=stat)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# -------------------- Password hashing --------------------
+
+class PasswordPoolBusy(Exception):
+    pass
+
+_password_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='pwhash')
+# يحد عدد المهام المنفذة + المنتظرة
+_password_slots = threading.BoundedSemaphore(PASSWORD_HASH_WORKERS + PASSWORD_HASH_MAX_QUEUE)
+password_pool_stats = {
+    'completed': 0, 'rejected': 0, 'in_flight': 0,
+    'wait_seconds_sum': 0.0, 'wait_seconds_max': 0.0,
+    'run_seconds_sum': 0.0, 'run_seconds_max': 0.0,
+}
+_password_stats_lock = threading.Lock()
+
+def run_password_task(fn, *args):
+    """Run a slow KDF call (hash/verify) on the dedicated password pool.
+
+    Raises PasswordPoolBusy instead of queueing once PASSWORD_HASH_MAX_QUEUE
+    tasks are already running or waiting; the app answers 503 + Retry-After.
+    """
+    if not _password_slots.acquire(blocking=False):
+        with _password_stats_lock:
+            password_pool_stats['rejected'] += 1
+        raise PasswordPoolBusy()
+    submitted = time.perf_counter()
+    with _password_stats_lock:
+        password_pool_stats['in_flight'] += 1
+
+    def task():
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            ended = time.perf_counter()
+            with _password_stats_lock:
+                st = password_pool_stats
+                st['completed'] += 1
+                st['in_flight'] -= 1
+                st['wait_seconds_sum'] += started - submitted
+                st['wait_seconds_max'] = max(st['wait_seconds_max'], started - submitted)
+                st['run_seconds_sum'] += ended - started
+                st['run_seconds_max'] = max(st['run_seconds_max'], ended - started)
+            _password_slots.release()
+
+    return _password_pool.submit(task).result()
 
 # -------------------- Models --------------------
+class IdSpace(db.Model):
+    # صف واحد في كل قاعدة (مع الشاردات فقط): location = 0 للرئيسية و n+1 للشارد n، والمعرفات
+    # الجديدة تبدأ فوق floor، الذي يُرفع عند نقل مستخدم حتى لا يُعاد استعمال معرفاته
+    location = db.Column(db.Integer, primary_key=True)
+    floor = db.Column(db.Integer, nullable=False, default=0)
+
+def location_id(table_name):
+    """Default for ids that stay unique across the main database and the shards.
+
+    The next multiple of ID_STRIDE above both the table's highest id and the
+    database's IdSpace.floor, plus the database's location. It is evaluated
+    inside the INSERT, under SQLite's write lock, so concurrent writers never
+    collide. Without an IdSpace row (no shards) SQLite assigns the id as usual.
+    """
+    top = db.select(db.func.max(sa.table(table_name, sa.column('id')).c.id)).scalar_subquery()
+    return db.select(
+        (db.func.max(db.func.coalesce(top, 0), IdSpace.floor) // ID_STRIDE + 1) * ID_STRIDE + IdSpace.location
+    ).scalar_subquery()
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120))
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
     balance_dz = db.Column(db.Float, default=0.0)
+    # يزداد مع كل تعديل على بيانات المستخدم؛ أساس ETag و Last-Modified
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    data_updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def set_password(self, pw):
-        self.password_hash = generate_password_hash(pw)
+        self.password_hash = run_password_task(generate_password_hash, pw)
 
     def check_password(self, pw):
-        return check_password_hash(self.password_hash, pw)
+        return run_password_task(check_password_hash, self.password_hash, pw)
 
 class Purchase(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, default=location_id('purchase'))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     item_name = db.Column(db.String(200))
     price_dz = db.Column(db.Float, nullable=False)
     category = db.Column(db.String(100))
     date = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_purchase_user_date', 'user_id', 'date'),
+        db.Index('ix_purchase_date', 'date'),
+    )
+
+class PurchaseArchive(db.Model):
+    # مشتريات شهر كامل لمستخدم واحد، أعمدة JSON مضغوطة بـ zlib، مع المجاميع محسوبة مسبقاً
+    user_id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Date, primary_key=True)  # أول يوم في الشهر
+    count = db.Column(db.Integer, nullable=False)
+    total_dz = db.Column(db.Float, nullable=False)
+    max_id = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class ReportLog(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, default=location_id('report_log'))
     user_id = db.Column(db.Integer)
     report_type = db.Column(db.String(20))
     total = db.Column(db.Float)
     start_date = db.Column(db.Date)
     end_date = db.Column(db.Date)
     sent_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # user:type:start:end للتقارير المجدولة و job:<id> لتقارير /reports، حتى لا يُرسل نفس التقرير مرتين
+    idempotency_key = db.Column(db.String(80))
+
+    __table_args__ = (
+        db.Index('ix_report_log_user_sent', 'user_id', 'sent_at'),
+        db.Index('ix_report_log_idempotency_key', 'idempotency_key', unique=True),
+    )
+
+class ReportJob(db.Model):
+    # تقارير مطلوبة عبر POST /reports، تُنفذ في مجمع خيوط محدود خارج الطلب
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    report_type = db.Column(db.String(20), nullable=False)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    send_email = db.Column(db.Boolean, nullable=False, default=False)
+    email = db.Column(db.String(120))
+    # نفس الطلب بنفس البيانات = نفس المفتاح؛ مهمة واحدة فقط قيد التنفيذ لكل مفتاح
+    dedup_key = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued / running / done / failed
+    version = db.Column(db.String(80))  # مفتاح ملف PDF في كاش التقارير
+    total = db.Column(db.Float)
+    report_log_id = db.Column(db.Integer)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_report_job_user_created', 'user_id', 'created_at'),
+        db.Index('ix_report_job_in_flight', 'dedup_key', unique=True,
+                 sqlite_where=db.text("status IN ('queued', 'running')")),
+    )
+
+class ShardMap(db.Model):
+    # مكان بيانات كل مستخدم: رقم الشارد؛ غياب السطر = القاعدة الرئيسية
+    user_id = db.Column(db.Integer, primary_key=True)
+    shard = db.Column(db.Integer, nullable=False)
+    moved_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SchedulerLease(db.Model):
+    # عقد إيجار القائد: صف واحد لكل اسم، يجدده القائد قبل انتهاء expires_at
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(120), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class JobRun(db.Model):
+    # آخر تشغيل ناجح لكل مهمة مجدولة، يبقى بعد إعادة التشغيل
+    name = db.Column(db.String(50), primary_key=True)
+    last_started_at = db.Column(db.DateTime)
+    last_success_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    last_stats = db.Column(db.Text)  # JSON
+
+class DailyCategoryTotal(db.Model):
+    # مجاميع يومية لكل مستخدم وفئة، تُحدَّث في نفس معاملة إضافة/تعديل/حذف المشتريات
+    user_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    category = db.Column(db.String(100), primary_key=True, default='')
+    total_dz = db.Column(db.Float, nullable=False, default=0.0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class BalanceLedger(db.Model):
+    # سجل إضافي فقط لكل تغيير في الرصيد (لا يُعدَّل ولا يُحذف)
+    id = db.Column(db.Integer, primary_key=True, default=location_id('balance_ledger'))
+    user_id = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Float, nullable=False)  # موجب = إيداع، سالب = مصروف
+    reason = db.Column(db.String(20), nullable=False)  # opening / purchase / batch / import
+    purchase_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_balance_ledger_user_created', 'user_id', 'created_at'),
+    )
+
+class BalanceSnapshot(db.Model):
+    # الرصيد المحسوب من السجل حتى ledger_id، يؤخذ دورياً
+    id = db.Column(db.Integer, primary_key=True, default=location_id('balance_snapshot'))
+    user_id = db.Column(db.Integer, nullable=False)
+    ledger_id = db.Column(db.Integer, nullable=False)
+    balance_dz = db.Column(db.Float, nullable=False)
+    taken_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_balance_snapshot_user_taken', 'user_id', 'taken_at'),
+        db.Index('ix_balance_snapshot_user_ledger', 'user_id', 'ledger_id'),
+    )
+
+class EmailOutbox(db.Model):
+    # رسائل التقارير تُحفظ هنا أولاً، ثم يرسلها عامل التسليم مع إعادة المحاولة
+    id = db.Column(db.Integer, primary_key=True)
+    to_email = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200))
+    body = db.Column(db.Text)
+    attachment = db.Column(db.LargeBinary)
+    attachment_name = db.Column(db.String(200))
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending / sending / sent / failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claim_token = db.Column(db.String(32))
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    # نفس مفتاح ReportLog للتقارير المجدولة ولمهام /reports: الرسالة تُحفظ قبل السجل (قد يكون في شارد آخر)،
+    # فإعادة التشغيل بعد انقطاع بينهما لا تضيف نسخة ثانية
+    idempotency_key = db.Column(db.String(80))
+
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next', 'status', 'next_attempt_at'),
+        db.Index('ix_email_outbox_idempotency_key', 'idempotency_key', unique=True),
+    )
+
+# نسخة خفيفة من المستخدم لتوليد التقارير دون كائنات ORM
+ReportUser = namedtuple('ReportUser', 'id name email')
+# ما يحتاجه token_required من المستخدم، بدون جلسة قاعدة البيانات؛ shard هو مكان بياناته (None = الرئيسية)
+UserSnapshot = namedtuple('UserSnapshot', 'id name email balance_dz shard')
+# سطر مشتريات من الأرشيف، بنفس حقول PURCHASE_COLUMNS
+ArchivedPurchase = namedtuple('ArchivedPurchase', 'id item_name price_dz category date')
+
+# -------------------- Sharding --------------------
+# المستخدم (الحساب وكلمة المرور) في القاعدة الرئيسية دائماً؛ مع SHARDS=N تنتقل مشترياته
+# وتجميعاته وسجل رصيده وتقاريره إلى شارد، ومعها نسخة من سطر user تحمل الرصيد و data_version
+
+def current_shard():
+    return _current_shard.get()
+
+@contextmanager
+def use_shard(shard):
+    # route per-user tables to shard `shard` (None = main database) inside the block
+    token = _current_shard.set(shard)
+    try:
+        yield
+    finally:
+        _current_shard.reset(token)
+
+def shard_for_user(user_id):
+    # where the user's data lives now: a shard index, or None for the main database
+    if not SHARD_COUNT:
+        return None
+    return db.session.query(ShardMap.shard).filter(ShardMap.user_id == user_id).scalar()
+
+def user_shard(user_id):
+    return use_shard(shard_for_user(user_id))
+
+def target_shard(user_id):
+    # placement by user_id hash; rebalance-shards moves users that are elsewhere
+    return int(hashlib.sha1(str(user_id).encode()).hexdigest(), 16) % SHARD_COUNT
+
+def location_engine(location):
+    return db.engine if location is None else db.engines[f'shard{location}']
+
+def shard_locations():
+    # the main database first: users registered before sharding stay there until moved
+    return [None] + list(range(SHARD_COUNT))
+
+def for_each_location(fn):
+    """Run fn() against the main database and every shard in parallel; returns [(location, result)]."""
+    locations = shard_locations()
+    if len(locations) == 1:
+        return [(None, fn())]
+    app = current_app._get_current_object()
+
+    def run(location):
+        with app.app_context(), use_shard(location):
+            try:
+                return location, fn()
+            finally:
+                db.session.remove()
+
+    with ThreadPoolExecutor(max_workers=len(locations), thread_name_prefix='shard') as pool:
+        return list(pool.map(run, locations))
+
+def assign_shard(user):
+    # new users go straight to their shard: map row in main, user row copied to the shard
+    if not SHARD_COUNT:
+        return
+    shard = target_shard(user.id)
+    db.session.add(ShardMap(user_id=user.id, shard=shard))
+    db.session.flush()
+    row = {c.name: getattr(user, c.key) for c in User.__table__.columns}
+    with use_shard(shard):
+        db.session.execute(db.insert(User), [row])
+
+# per-user tables in copy order: rows that others point to come first
+SHARDED_TABLES = ('purchase', 'purchase_archive', 'daily_category_total', 'balance_ledger', 'balance_snapshot', 'report_log')
+
+def move_user_data(user_id, target):
+    """Move one user's rows to `target` (shard index, or None for the main database).
+
+    Rows are copied with their ids in one transaction at the target, the shard
+    map is switched, then the source rows are deleted and the source's IdSpace
+    floor is raised past them, so the ids never come back. Ids from different
+    databases never collide (see location_id). Run it while the user is not writing: other workers
+    keep routing the user by the shard cached in its auth snapshot for up to
+    AUTH_CACHE_TTL seconds after the move. Returns the number of rows copied.
+    """
+    source = shard_for_user(user_id)
+    db.session.commit()  # release the read before the copy writes to the main database
+    if source == target:
+        return 0
+    tables = db.metadata.tables
+    user_t, purchase_t = tables['user'], tables['purchase']
+    copied = 0
+    with location_engine(source).connect() as src, location_engine(target).begin() as dst:
+        if dst.execute(db.select(db.func.count()).select_from(purchase_t)
+                       .where(purchase_t.c.user_id == user_id)).scalar():
+            raise RuntimeError(f'user {user_id} already has purchases at the target')
+        user_row = dict(src.execute(db.select(user_t).where(user_t.c.id == user_id)).mappings().one())
+        if target is None:
+            # the main row is the account itself; only the shard-held fields come back
+            dst.execute(db.update(user_t).where(user_t.c.id == user_id).values(
+                balance_dz=user_row['balance_dz'], data_version=user_row['data_version'],
+                data_updated_at=user_row['data_updated_at']))
+        else:
+            dst.execute(db.delete(user_t).where(user_t.c.id == user_id))
+            dst.execute(db.insert(user_t), [user_row])
+        top = 0
+        for name in SHARDED_TABLES:
+            table = tables[name]
+            rows = [dict(r) for r in src.execute(
+                db.select(table).where(table.c.user_id == user_id).order_by(*table.primary_key.columns)
+            ).mappings()]
+            if not rows:
+                continue
+            if 'id' in table.c:
+                top = max(top, rows[-1]['id'])
+            try:
+                dst.execute(db.insert(table), rows)
+            except IntegrityError as e:
+                # only ids written before the IdSpace rows existed can clash
+                raise RuntimeError(f'user {user_id}: {name} ids already taken at the target ({e.orig})')
+            copied += len(rows)
+    if target is None:
+        ShardMap.query.filter_by(user_id=user_id).delete()
+    else:
+        db.session.merge(ShardMap(user_id=user_id, shard=target, moved_at=datetime.utcnow()))
+    db.session.commit()
+    with location_engine(source).begin() as src:
+        for name in reversed(SHARDED_TABLES):
+            src.execute(db.delete(tables[name]).where(tables[name].c.user_id == user_id))
+        if source is not None:
+            src.execute(db.delete(user_t).where(user_t.c.id == user_id))
+        src.execute(db.update(IdSpace).values(floor=db.func.max(IdSpace.floor, top)))
+    return copied
 
 # -------------------- Utilities --------------------
+# token -> (expires_at, user_id) و user_id -> (expires_at, UserSnapshot)، بترتيب آخر استخدام
+_token_cache = OrderedDict()
+_user_cache = OrderedDict()
+_auth_cache_lock = threading.Lock()
+
+def snapshot_user(user, shard):
+    return UserSnapshot(user.id, user.name, user.email, user.balance_dz, shard)
+
+def cache_user(snapshot):
+    # store (or refresh, e.g. after a balance change) a user's snapshot
+    with _auth_cache_lock:
+        _user_cache[snapshot.id] = (time.time() + AUTH_CACHE_TTL, snapshot)
+        _user_cache.move_to_end(snapshot.id)
+        while len(_user_cache) > AUTH_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+
+def invalidate_user_cache(user_id):
+    with _auth_cache_lock:
+        _user_cache.pop(user_id, None)
+
+def _cached_user(user_id, now):
+    # the user's snapshot while it is fresh, else None; call with _auth_cache_lock held
+    entry = _user_cache.get(user_id)
+    if entry is None:
+        return None
+    if entry[0] <= now:
+        # written by another worker or an admin edit since; reload from the DB
+        del _user_cache[user_id]
+        return None
+    _user_cache.move_to_end(user_id)
+    return entry[1]
+
+def authenticate(token):
+    """Resolve a JWT to a UserSnapshot; raises if the token or user is invalid.
+
+    Decoded tokens are kept for AUTH_CACHE_TTL seconds (never past the token's
+    exp) and user snapshots, with the user's shard, for AUTH_CACHE_TTL seconds
+    after they were loaded, so repeat requests skip jwt.decode and the DB.
+    """
+    now = time.time()
+    with _auth_cache_lock:
+        entry = _token_cache.get(token)
+        if entry and entry[0] > now:
+            _token_cache.move_to_end(token)
+            snapshot = _cached_user(entry[1], now)
+            if snapshot is not None:
+                return snapshot
+    data = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+    user_id = data['id']
+    with _auth_cache_lock:
+        snapshot = _cached_user(user_id, now)
+    if snapshot is None:
+        shard = shard_for_user(user_id)
+        with use_shard(shard):
+            user = db.session.get(User, user_id)
+        if not user:
+            raise Exception('User not found')
+        snapshot = snapshot_user(user, shard)
+        cache_user(snapshot)
+    expires_at = min(now + AUTH_CACHE_TTL, data.get('exp', now + AUTH_CACHE_TTL))
+    with _auth_cache_lock:
+        _token_cache[token] = (expires_at, user_id)
+        _token_cache.move_to_end(token)
+        while len(_token_cache) > AUTH_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return snapshot
+
 def token_required(f):
+    # the handler gets a read-only UserSnapshot; load the ORM User only to write
     @wraps(f)
     def decorator(*args, **kwargs):
         token = request.headers.get('Authorization', None)
@@ -70,65 +674,1280 @@ def token_required(f):
         if token.startswith('Bearer '):
             token = token.split(' ')[1]
         try:
-            data = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
-            current_user = User.query.get(data['id'])
-            if not current_user:
-                raise Exception('User not found')
+            current_user = authenticate(token)
         except Exception as e:
             return jsonify({'message': 'Token is invalid'}), 401
-        return f(current_user, *args, **kwargs)
+        # everything the handler reads or writes about this user goes to the user's shard
+        with use_shard(current_user.shard):
+            return f(current_user, *args, **kwargs)
     return decorator
 
-def generate_pdf_report(user: User, purchases, title='تقرير المصاريف'):
-    buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
-    y = height - 50
-    c.setFont("Helvetica-Bold", 14)
-    c.drawString(50, y, title)
-    y -= 30
-    c.setFont("Helvetica", 11)
-    c.drawString(50, y, f"المستخدم: {user.name} -- الإيميل: {user.email}")
-    y -= 20
-    c.drawString(50, y, f"تاريخ التوليد: {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}")
-    y -= 30
-    total = 0.0
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, y, "التفاصيل:")
-    y -= 20
-    c.setFont("Helvetica", 10)
-    for p in purchases:
-        line = f"{p.date.strftime('%Y-%m-%d')} | {p.category or '-'} | {p.item_name} | {p.price_dz:.2f} د.ج"
-        c.drawString(50, y, line)
-        y -= 15
-        total += p.price_dz
-        if y < 80:
-            c.showPage()
-            y = height - 50
-    y -= 10
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, y, f"الإجمالي: {total:.2f} د.ج")
-    c.save()
-    buffer.seek(0)
-    return buffer, total
+PURCHASE_COLUMNS = (Purchase.id, Purchase.item_name, Purchase.price_dz, Purchase.category, Purchase.date)
 
-def send_email_with_pdf(to_email: str, subject: str, body: str, pdf_bytes: BytesIO, pdf_filename='report.pdf'):
-    if not EMAIL_ADDRESS or not EMAIL_PASSWORD:
-        raise RuntimeError("EMAIL_ADDRESS and EMAIL_PASSWORD must be set")
+def purchase_to_dict(p):
+    return {
+        'id': p.id,
+        'item_name': p.item_name,
+        'price_dz': p.price_dz,
+        'category': p.category,
+        'date': p.date.strftime('%Y-%m-%d')
+    }
+
+def encode_cursor(p):
+    # opaque keyset cursor on (date, id) of the last row of a page
+    raw = json.dumps([p.date.isoformat(), p.id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    dt_str, pid = json.loads(raw)
+    return datetime.fromisoformat(dt_str), int(pid)
+
+def keyset_after(q, key):
+    # rows strictly after `key` in (date desc, id desc) order; the plain `date <= dt`
+    # bound is what lets SQLite seek ix_purchase_user_date instead of scanning the user's rows
+    dt, pid = key
+    return q.filter(Purchase.date <= dt, db.or_(
+        Purchase.date < dt,
+        db.and_(Purchase.date == dt, Purchase.id < pid)
+    ))
+
+def fts_match(text, user_id):
+    """FTS5 MATCH expression for a free-text search, restricted to one user's rows.
+
+    Every word must match a whole word of the item name or the category; a word
+    ending in * matches as a prefix ("dolip*"). Words are quoted, so any other
+    FTS5 syntax typed by the user is searched as plain text.
+    """
+    words = []
+    for term in text.split():
+        prefix = term.endswith('*') and len(term) > 1
+        term = (term[:-1] if prefix else term).replace('"', '""')
+        if term.strip('"*'):
+            words.append(f'"{term}"*' if prefix else f'"{term}"')
+    if not words:
+        raise ValueError('empty search')
+    return f'owner : "u{int(user_id)}" AND {{item_name category}} : ({" AND ".join(words)})'
+
+def fts_purchase_ids(match):
+    # rowids (= purchase ids) of the purchase_fts rows matching an FTS5 expression
+    return db.select(db.literal_column('rowid')).select_from(db.table('purchase_fts')).where(
+        db.text('purchase_fts MATCH :fts_match').bindparams(fts_match=match)
+    )
+
+def search_query(user_id, match):
+    # a user's purchases whose item name or category match the FTS5 expression
+    return db.session.query(*PURCHASE_COLUMNS).filter(
+        Purchase.id.in_(fts_purchase_ids(match)),
+        Purchase.user_id == user_id
+    )
+
+EXPORT_FIELDS = ('id', 'date', 'item_name', 'category', 'price_dz')
+
+def stream_purchases(rows, fmt='ndjson'):
+    # rows: a lazy iterator (server-side cursor, archive months), so memory stays flat
+    shard = current_shard()
+
+    def generate():
+        # runs after the view has returned, so the shard is selected again here
+        with use_shard(shard):
+            yield from render()
+
+    def render():
+        if fmt == 'ndjson':
+            for p in rows:
+                yield json.dumps(purchase_to_dict(p), ensure_ascii=False) + '\n'
+            return
+        if fmt == 'csv':
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(EXPORT_FIELDS)
+            for i, p in enumerate(rows, 1):
+                d = purchase_to_dict(p)
+                writer.writerow([d[f] for f in EXPORT_FIELDS])
+                if i % STREAM_BATCH_SIZE == 0:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+            yield buf.getvalue()
+            return
+        yield '['
+        first = True
+        for p in rows:
+            yield ('' if first else ',') + json.dumps(purchase_to_dict(p), ensure_ascii=False)
+            first = False
+        yield ']'
+
+    mimetype = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}.get(fmt, 'application/json')
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+def spool_upload(stream, max_bytes):
+    # copy the request body to a temp file (memory first, then disk) before touching the DB
+    spooled = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    size = 0
+    while True:
+        chunk = stream.read(64 * 1024)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            spooled.close()
+            raise ValueError(f'upload larger than {max_bytes} bytes')
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
+
+def parse_purchase(data):
+    # validates one purchase payload; raises on bad input
+    price_dz = float(data['price_dz'])
+    if price_dz != price_dz or price_dz in (float('inf'), float('-inf')):
+        raise ValueError('price_dz must be a finite number')
+    dt_str = data.get('date')
+    if dt_str:
+        dt = datetime.strptime(dt_str, '%Y-%m-%d')
+    else:
+        dt = datetime.utcnow()
+    return {
+        'item_name': data['item_name'],
+        'price_dz': price_dz,
+        'category': data.get('category', None),
+        'date': dt
+    }
+
+def apply_to_aggregates(rows, sign=1):
+    """Add (sign=1) or remove (sign=-1) purchases from DailyCategoryTotal.
+
+    `rows` are dicts or objects with user_id, date, category and price_dz. The
+    upsert runs on the current session, so it commits together with the purchases.
+    """
+    deltas = {}
+    for r in rows:
+        if not isinstance(r, dict):
+            r = {'user_id': r.user_id, 'date': r.date, 'category': r.category, 'price_dz': r.price_dz}
+        key = (r['user_id'], r['date'].date(), r.get('category') or '')
+        total, count = deltas.get(key, (0.0, 0))
+        deltas[key] = (total + sign * r['price_dz'], count + sign)
+    if not deltas:
+        return
+    stmt = sqlite_insert(DailyCategoryTotal).values([
+        {'user_id': k[0], 'day': k[1], 'category': k[2], 'total_dz': v[0], 'count': v[1]}
+        for k, v in deltas.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'day', 'category'],
+        set_={
+            'total_dz': DailyCategoryTotal.total_dz + stmt.excluded.total_dz,
+            'count': DailyCategoryTotal.count + stmt.excluded.count,
+        }
+    )
+    db.session.execute(stmt)
+
+def data_version_bump():
+    # column values for an UPDATE of User after any change to the user's data
+    return {'data_version': User.data_version + 1, 'data_updated_at': datetime.utcnow()}
+
+def user_data_version(user_id):
+    # (version, last_modified) read from the User row only, never from Purchase
+    return db.session.query(User.data_version, User.data_updated_at).filter(User.id == user_id).one()
+
+def make_etag(*parts):
+    return hashlib.sha256('|'.join(map(str, parts)).encode()).hexdigest()[:32]
+
+def not_modified(etag, last_modified=None):
+    """304 response if the request's validators still match, else None.
+
+    Called before the expensive query; If-None-Match wins over If-Modified-Since.
+    Other methods than GET and HEAD get a 412 instead and ignore
+    If-Modified-Since (RFC 9110, 13.1.2 and 13.1.3).
+    """
+    safe = request.method in ('GET', 'HEAD')
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        fresh = bool(safe and last_modified and request.if_modified_since and last_modified <= request.if_modified_since)
+    if not fresh:
+        return None
+    return with_validators(Response(status=304 if safe else 412), etag, last_modified)
+
+def with_validators(resp, etag, last_modified=None):
+    resp.set_etag(etag)
+    if last_modified is not None:
+        resp.last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+    return resp
+
+def adjust_balance(user_id, delta, reason, purchase_id=None):
+    """Atomically add `delta` to a user's balance and append it to the ledger.
+
+    A single UPDATE ... SET balance_dz = balance_dz + ? RETURNING, so there is
+    no read-modify-write race and no User row load. Returns the new balance.
+    """
+    balance = db.session.execute(
+        db.update(User).where(User.id == user_id)
+        .values(balance_dz=db.func.coalesce(User.balance_dz, 0.0) + delta, **data_version_bump())
+        .returning(User.balance_dz)
+        .execution_options(synchronize_session=False)
+    ).scalar_one()
+    db.session.add(BalanceLedger(user_id=user_id, amount=delta, reason=reason, purchase_id=purchase_id))
+    return balance
+
+def balance_at(user_id, when: datetime):
+    # latest snapshot at or before `when` plus the ledger entries since: O(log n + entries per period)
+    snap = BalanceSnapshot.query.filter(
+        BalanceSnapshot.user_id == user_id, BalanceSnapshot.taken_at <= when
+    ).order_by(BalanceSnapshot.taken_at.desc()).first()
+    since = db.session.query(db.func.coalesce(db.func.sum(BalanceLedger.amount), 0.0)).filter(
+        BalanceLedger.user_id == user_id,
+        BalanceLedger.created_at <= when,
+        BalanceLedger.id > (snap.ledger_id if snap else 0)
+    )
+    if snap:
+        # lower bound for the (user_id, created_at) index; the slack covers entries
+        # stamped just before the snapshot but committed after it
+        since = since.filter(BalanceLedger.created_at >= snap.taken_at - timedelta(days=1))
+    return (snap.balance_dz if snap else 0.0) + since.scalar()
+
+def snapshot_balances():
+    """Snapshot every user with ledger entries since their last snapshot.
+
+    Each new snapshot is the previous one plus the newer ledger entries (never
+    User.balance_dz), so reconcile_balances can detect drift. Returns the count.
+    """
+    # ids as location_id() would give them, one ID_STRIDE apart (NULL, i.e. SQLite's own, without shards)
+    result = db.session.execute(db.text('''
+        INSERT INTO balance_snapshot (id, user_id, ledger_id, balance_dz, taken_at)
+        SELECT (SELECT max(coalesce((SELECT max(id) FROM balance_snapshot), 0), floor) / :stride * :stride + location
+                FROM id_space) + :stride * row_number() OVER (ORDER BY l.user_id),
+               l.user_id, max(l.id), coalesce(s.balance_dz, 0) + sum(l.amount), :now
+        FROM balance_ledger l
+        LEFT JOIN balance_snapshot s ON s.id = (
+            SELECT id FROM balance_snapshot WHERE user_id = l.user_id ORDER BY ledger_id DESC LIMIT 1
+        )
+        WHERE l.id > coalesce(s.ledger_id, 0)
+        GROUP BY l.user_id
+    '''), {'now': datetime.utcnow(), 'stride': ID_STRIDE})
+    db.session.commit()
+    return result.rowcount
+
+def reconcile_balances():
+    # [(user_id, stored balance, ledger balance)] for users whose balance drifted from the ledger;
+    # in the main database, users moved to a shard are skipped (their balance lives there)
+    rows = db.session.execute(db.text('''
+        SELECT u.id, u.balance_dz,
+               coalesce(s.balance_dz, 0) + coalesce((
+                   SELECT sum(amount) FROM balance_ledger
+                   WHERE user_id = u.id AND id > coalesce(s.ledger_id, 0)
+               ), 0) AS ledger_balance
+        FROM user u
+        LEFT JOIN balance_snapshot s ON s.id = (
+            SELECT id FROM balance_snapshot WHERE user_id = u.id ORDER BY ledger_id DESC LIMIT 1
+        )
+        WHERE u.id NOT IN (SELECT user_id FROM shard_map)
+    ''')).all()
+    return [(uid, bal, ledger) for uid, bal, ledger in rows if abs((bal or 0.0) - ledger) > 0.005]
+
+def daily_totals(user_id, start: date, end: date):
+    # [(day, category, total_dz, count)] from the aggregates, O(days * categories)
+    return db.session.query(
+        DailyCategoryTotal.day, DailyCategoryTotal.category,
+        DailyCategoryTotal.total_dz, DailyCategoryTotal.count
+    ).filter(
+        DailyCategoryTotal.user_id == user_id,
+        DailyCategoryTotal.day >= start,
+        DailyCategoryTotal.day <= end,
+        DailyCategoryTotal.count > 0
+    ).order_by(DailyCategoryTotal.day).all()
+
+def range_totals(user_id, start: date, end: date):
+    # (total, count) of a user's purchases between two dates, without touching Purchase
+    total, count = db.session.query(
+        db.func.coalesce(db.func.sum(DailyCategoryTotal.total_dz), 0.0),
+        db.func.coalesce(db.func.sum(DailyCategoryTotal.count), 0)
+    ).filter(
+        DailyCategoryTotal.user_id == user_id,
+        DailyCategoryTotal.day >= start,
+        DailyCategoryTotal.day <= end
+    ).one()
+    return float(total), int(count)
+
+def week_start(d: date):
+    # weeks start on Sunday
+    return d - timedelta(days=(d.weekday() + 1) % 7)
+
+def range_bounds(start: date, end: date):
+    # [start, end] in days -> [start, end) in datetimes, as archived_purchases takes it
+    return datetime.combine(start, datetime.min.time()), datetime.combine(end + timedelta(days=1), datetime.min.time())
+
+def purchases_in_range(user_id, start: date, end: date):
+    # purchases of one user between two dates (inclusive), served by ix_purchase_user_date
+    return Purchase.query.filter(
+        Purchase.user_id == user_id,
+        Purchase.date >= datetime.combine(start, datetime.min.time()),
+        Purchase.date <= datetime.combine(end, datetime.max.time())
+    )
+
+def report_rows(purchases):
+    # ORM rows -> plain tuples that can be pickled to a render process
+    return [(p.date.strftime('%Y-%m-%d'), p.category, p.item_name, p.price_dz) for p in purchases]
+
+def get_report_pool():
+    # the pool is created on first use; REPORT_WORKERS=0 renders in the calling thread
+    global _report_pool
+    if REPORT_WORKERS <= 0:
+        return None
+    with _report_pool_lock:
+        if _report_pool is None:
+            # never fork this process: it runs threads (scheduler, write queue, pools) whose locks a
+            # forked child could inherit held; workers fork from a clean server with ReportLab preloaded
+            ctx = multiprocessing.get_context('forkserver')
+            ctx.set_forkserver_preload(['pdf_report'])
+            _report_pool = ProcessPoolExecutor(max_workers=REPORT_WORKERS, mp_context=ctx)
+        return _report_pool
+
+def submit_report_render(user, purchases, title, total=None) -> Future:
+    """Render a report in the process pool; the future resolves to (pdf_bytes, total)."""
+    args = (user.name, user.email, report_rows(purchases), title, total)
+    started = time.perf_counter()
+    from pdf_report import render_report_pdf  # ReportLab is loaded on the first report
+    pool = get_report_pool()
+    if pool is not None:
+        fut = pool.submit(render_report_pdf, *args)
+        fut.add_done_callback(lambda f: REPORT_RENDER_SECONDS.observe(time.perf_counter() - started, mode='pool'))
+        return fut
+    fut = Future()
+    try:
+        fut.set_result(render_report_pdf(*args))
+    except Exception as e:
+        fut.set_exception(e)
+    REPORT_RENDER_SECONDS.observe(time.perf_counter() - started, mode='inline')
+    return fut
+
+def generate_pdf_report(user: User, purchases, title='تقرير المصاريف', total=None):
+    pdf_bytes, total = submit_report_render(user, purchases, title, total).result()
+    return BytesIO(pdf_bytes), total
+
+def report_title(rtype, start, end):
+    if rtype == 'custom':
+        return f"تقرير المصاريف من {start} إلى {end}"
+    label = 'أسبوعي' if rtype == 'weekly' else 'شهري'
+    return f"تقرير {label} من {start} إلى {end}"
+
+def render_report_file(user, rows, title, total, path):
+    """Render straight from a row iterator into `path`; returns (total, file).
+
+    The PDF is written page by page to a temp file next to `path` and moved
+    into place, so peak memory does not grow with the number of rows. The file
+    comes back open for reading, so a concurrent eviction cannot take it away.
+    """
+    from pdf_report import render_report_to
+    started = time.perf_counter()
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    f = os.fdopen(fd, 'w+b')
+    try:
+        rows = ((p.date.strftime('%Y-%m-%d'), p.category, p.item_name, p.price_dz) for p in rows)
+        total = render_report_to(f, user.name, user.email, rows, title, total)
+        f.flush()
+        os.replace(tmp, path)
+    except BaseException:
+        f.close()
+        os.remove(tmp)
+        raise
+    f.seek(0)
+    REPORT_RENDER_SECONDS.observe(time.perf_counter() - started, mode='stream')
+    return total, f
+
+def report_window(rtype, data, today: date):
+    # (start, end) of a weekly / monthly / custom report; raises ValueError with a client message
+    if rtype == 'weekly':
+        start = today - timedelta(days=today.weekday() + 1)
+        return start, start + timedelta(days=6)
+    if rtype == 'custom':
+        try:
+            start = datetime.strptime(data['start'], '%Y-%m-%d').date()
+            end = datetime.strptime(data['end'], '%Y-%m-%d').date()
+        except Exception:
+            raise ValueError('custom reports need start and end (YYYY-MM-DD)')
+        if start > end:
+            raise ValueError('start must be before end')
+        return start, end
+    start = date(today.year, today.month, 1)
+    if today.month == 12:
+        return start, date(today.year, 12, 31)
+    return start, date(today.year, today.month + 1, 1) - timedelta(days=1)
+
+def build_report(user, rtype, start, end):
+    """Render a user's report, or reuse it from the cache.
+
+    Returns (version, total, pdf_bytes, pdf_file); large ranges are rendered from
+    a server-side cursor straight into the cache file and only pdf_file, already
+    open for reading, is set. The caller closes it.
+    """
+    title = report_title(rtype, start, end)
+    version, total, count = range_version(user.id, start, end)
+    if count > REPORT_STREAM_THRESHOLD:
+        pdf_file = report_cache_get(user.id, rtype, start, end, version, read=False)
+        if pdf_file is None:
+            rows = purchases_in_range(user.id, start, end).with_entities(*PURCHASE_COLUMNS).order_by(
+                Purchase.date, Purchase.id
+            ).yield_per(STREAM_BATCH_SIZE)
+            rows = with_archive(rows, user.id, *range_bounds(start, end))
+            pdf_path = report_cache_path(user.id, rtype, start, end, version)
+            _, pdf_file = render_report_file(user, rows, title, total, pdf_path)
+            evict_report_cache(os.fstat(pdf_file.fileno()).st_size)
+        return version, total, None, pdf_file
+    pdf_bytes = report_cache_get(user.id, rtype, start, end, version)
+    if pdf_bytes is None:
+        purchases = list(with_archive(purchases_in_range(user.id, start, end).order_by(Purchase.date, Purchase.id),
+                                      user.id, *range_bounds(start, end)))
+        pdf_bytes, total = submit_report_render(user, purchases, title, total).result()
+        report_cache_put(user.id, rtype, start, end, version, pdf_bytes)
+    return version, total, pdf_bytes, None
+
+def report_email(rtype, start, end, total):
+    # (subject, body) of a report requested by the user
+    subject = f"تقرير المصاريف - {rtype}"
+    body = f"أرسل لك تقرير {rtype} للمصاريف من {start} إلى {end}. الإجمالي: {total:.2f} د.ج"
+    return subject, body
+
+# -------------------- Report cache --------------------
+
+def purchase_set_version(count, total, max_id):
+    # changes whenever a purchase in the range is added, removed or repriced
+    return f"{count}:{round(total or 0.0, 2):.2f}:{max_id or 0}"
+
+def range_version(user_id, start: date, end: date):
+    total, count = range_totals(user_id, start, end)
+    max_id = db.session.query(db.func.max(Purchase.id)).filter(
+        Purchase.user_id == user_id,
+        Purchase.date >= datetime.combine(start, datetime.min.time()),
+        Purchase.date <= datetime.combine(end, datetime.max.time())
+    ).scalar()
+    max_id = max(max_id or 0, archive_totals(user_id, start, end)[2])
+    return purchase_set_version(count, total, max_id), total, count
+
+def report_cache_path(user_id, rtype, start, end, version):
+    key = f"{user_id}|{rtype}|{start}|{end}|{version}"
+    return os.path.join(REPORT_CACHE_DIR, hashlib.sha256(key.encode()).hexdigest() + '.pdf')
+
+def report_cache_get(user_id, rtype, start, end, version, read=True):
+    # cached PDF bytes (or the file opened for reading with read=False), None on a miss;
+    # an open file stays readable even if another worker evicts it meanwhile
+    path = report_cache_path(user_id, rtype, start, end, version)
+    try:
+        os.utime(path)  # mtime is the LRU clock
+        if not read:
+            return open(path, 'rb')
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def report_cache_put(user_id, rtype, start, end, version, pdf_bytes):
+    try:
+        os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+        path = report_cache_path(user_id, rtype, start, end, version)
+        fd, tmp = tempfile.mkstemp(dir=REPORT_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pdf_bytes)
+        os.replace(tmp, path)  # atomic, so other workers never read a partial file
+        evict_report_cache(len(pdf_bytes))
+    except OSError as e:
+        print(f"Report cache write failed: {e}")
+
+# this process's estimate of the cache size, from the last scan plus its own writes since
+_report_cache_lock = threading.Lock()
+_report_cache_state = {'bytes': 0, 'scanned_at': None}
+
+def evict_report_cache(added=0):
+    """Account for `added` new bytes and trim the cache if it may be over REPORT_CACHE_MAX_BYTES.
+
+    The directory is only scanned when the estimate crosses the limit or the
+    last scan is older than REPORT_CACHE_SCAN_SECONDS; a scan trims down to
+    90% of the limit, so a full cache is not rescanned on every write.
+    """
+    now = time.monotonic()
+    with _report_cache_lock:
+        state = _report_cache_state
+        state['bytes'] += added
+        if state['bytes'] <= REPORT_CACHE_MAX_BYTES and state['scanned_at'] is not None \
+                and now - state['scanned_at'] < REPORT_CACHE_SCAN_SECONDS:
+            return
+        state['scanned_at'] = now
+    entries = []
+    for entry in os.scandir(REPORT_CACHE_DIR):
+        if entry.name.endswith('.pdf'):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    size = sum(e[1] for e in entries)
+    if size > REPORT_CACHE_MAX_BYTES:
+        for _, entry_size, path in sorted(entries):
+            if size <= REPORT_CACHE_MAX_BYTES * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+    with _report_cache_lock:
+        _report_cache_state['bytes'] = size
+
+def build_email(to_email, subject, body, pdf_data: bytes, pdf_filename='report.pdf'):
+    from email.message import EmailMessage
     msg = EmailMessage()
     msg['Subject'] = subject
     msg['From'] = EMAIL_ADDRESS
     msg['To'] = to_email
     msg.set_content(body)
-    pdf_data = pdf_bytes.read()
-    msg.add_attachment(pdf_data, maintype='application', subtype='pdf', filename=pdf_filename)
-    with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) as smtp:
+    if pdf_data:
+        msg.add_attachment(pdf_data, maintype='application', subtype='pdf', filename=pdf_filename)
+    return msg
+
+def open_smtp():
+    import smtplib
+    if SMTP_USE_SSL:
+        if not EMAIL_ADDRESS or not EMAIL_PASSWORD:
+            raise RuntimeError("EMAIL_ADDRESS and EMAIL_PASSWORD must be set")
+        smtp = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=30)
+        smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+        return smtp
+    smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
+    smtp.ehlo()
+    if EMAIL_PASSWORD and smtp.has_extn('auth'):
         smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        smtp.send_message(msg)
+    return smtp
+
+def send_email_with_pdf(to_email: str, subject: str, body: str, pdf_bytes: BytesIO, pdf_filename='report.pdf'):
+    msg = build_email(to_email, subject, body, pdf_bytes.read(), pdf_filename)
+    started = time.perf_counter()
+    try:
+        with open_smtp() as smtp:
+            smtp.send_message(msg)
+    except Exception:
+        SMTP_ERRORS.inc(path='direct')
+        raise
+    SMTP_SEND_SECONDS.observe(time.perf_counter() - started, path='direct')
+
+# -------------------- Archive --------------------
+# الجدول purchase يبقى للأشهر الأخيرة فقط؛ الأقدم يُضغط في purchase_archive (سطر لكل مستخدم وشهر).
+# المجاميع اليومية daily_category_total لا تُلمس، فـ /summary والتحليلات لا تتغير.
+
+def month_start(d):
+    return date(d.year, d.month, 1)
+
+def add_months(d: date, n):
+    months = d.year * 12 + d.month - 1 + n
+    return date(months // 12, months % 12 + 1, 1)
+
+def archive_horizon(today: date):
+    # first day of the oldest month kept in the hot table; None when archiving is off
+    if ARCHIVE_AFTER_MONTHS <= 0:
+        return None
+    return add_months(month_start(today), -ARCHIVE_AFTER_MONTHS)
+
+def pack_purchases(rows):
+    # rows in (date, id) order -> zlib-compressed JSON, one list per column
+    columns = {
+        'id': [p.id for p in rows],
+        'item_name': [p.item_name for p in rows],
+        'price_dz': [p.price_dz for p in rows],
+        'category': [p.category for p in rows],
+        'date': [p.date.isoformat() for p in rows],
+    }
+    return zlib.compress(json.dumps(columns, ensure_ascii=False, separators=(',', ':')).encode(), 9)
+
+def unpack_purchases(data):
+    c = json.loads(zlib.decompress(data))
+    return [ArchivedPurchase(*row[:4], datetime.fromisoformat(row[4]))
+            for row in zip(c['id'], c['item_name'], c['price_dz'], c['category'], c['date'])]
+
+def purchase_key(p):
+    return p.date, p.id
+
+_archive_in_use = None
+
+def archive_in_use():
+    """Whether reads have to look at purchase_archive at all.
+
+    True while archiving is on. With ARCHIVE_AFTER_MONTHS=0 nothing gets
+    archived anywhere, so the databases are checked once per process for rows
+    left by an earlier run; without any, reads skip the archive query.
+    """
+    global _archive_in_use
+    if ARCHIVE_AFTER_MONTHS > 0:
+        return True
+    if _archive_in_use is None:
+        found = for_each_location(lambda: db.session.query(PurchaseArchive.user_id).first() is not None)
+        _archive_in_use = any(has_rows for _, has_rows in found)
+    return _archive_in_use
+
+def archived_purchases(user_id, start=None, end=None, newest_first=False, after=None):
+    """Archived purchases of a user with start <= date < end, in (date, id) order.
+
+    Only the months overlapping the range are read (one query), and each is
+    decompressed when the iteration reaches it. `after` is a (date, id) keyset
+    cursor for newest-first pages.
+    """
+    if not archive_in_use():
+        return
+    months = db.session.query(PurchaseArchive.data).filter(PurchaseArchive.user_id == user_id)
+    if start:
+        months = months.filter(PurchaseArchive.month >= month_start(start))
+    if end:
+        months = months.filter(PurchaseArchive.month <= end.date())
+    if after:
+        months = months.filter(PurchaseArchive.month <= after[0].date())
+    months = months.order_by(PurchaseArchive.month.desc() if newest_first else PurchaseArchive.month).all()
+    for data, in months:
+        rows = unpack_purchases(data)
+        if newest_first:
+            rows.reverse()
+        for p in rows:
+            if (start and p.date < start) or (end and p.date >= end) or (after and purchase_key(p) >= after):
+                continue
+            yield p
+
+def with_archive(rows, user_id, start=None, end=None, newest_first=False, after=None):
+    """Merge hot rows (PURCHASE_COLUMNS ordered by date and id) with the archived ones in the same range."""
+    if not archive_in_use():
+        return iter(rows)
+    archived = archived_purchases(user_id, start, end, newest_first, after)
+    return heapq.merge(rows, archived, key=purchase_key, reverse=newest_first)
+
+def archive_totals(user_id, start: date = None, end: date = None):
+    # (count, total, max_id) of the archived months overlapping [start, end], from their pre-computed totals
+    if not archive_in_use():
+        return 0, 0.0, 0
+    q = db.session.query(
+        db.func.coalesce(db.func.sum(PurchaseArchive.count), 0),
+        db.func.coalesce(db.func.sum(PurchaseArchive.total_dz), 0.0),
+        db.func.coalesce(db.func.max(PurchaseArchive.max_id), 0)
+    ).filter(PurchaseArchive.user_id == user_id)
+    if start:
+        q = q.filter(PurchaseArchive.month >= month_start(start))
+    if end:
+        q = q.filter(PurchaseArchive.month <= end)
+    count, total, max_id = q.one()
+    return int(count), float(total), max_id
+
+def archive_month(user_id, month: date):
+    """Move one user's purchases of `month` into its archive row; returns the number moved.
+
+    Rows that arrive later for an already archived month (e.g. an import with
+    old dates) are merged into the existing archive. The archive write, the
+    deletion of the hot rows and the data_version bump commit together.
+    """
+    start = datetime.combine(month, datetime.min.time())
+    end = datetime.combine(add_months(month, 1), datetime.min.time())
+    hot = db.session.query(*PURCHASE_COLUMNS).filter(
+        Purchase.user_id == user_id, Purchase.date >= start, Purchase.date < end
+    ).order_by(Purchase.date, Purchase.id).all()
+    if not hot:
+        return 0
+    archive = db.session.get(PurchaseArchive, (user_id, month))
+    if archive is None:
+        archive = PurchaseArchive(user_id=user_id, month=month)
+        db.session.add(archive)
+        rows = hot
+    else:
+        rows = list(heapq.merge(unpack_purchases(archive.data), hot, key=purchase_key))
+    archive.data = pack_purchases(rows)
+    archive.count = len(rows)
+    archive.total_dz = sum(p.price_dz for p in rows)
+    archive.max_id = max(p.id for p in rows)
+    archive.archived_at = datetime.utcnow()
+    Purchase.query.filter(Purchase.id.in_([p.id for p in hot])).delete(synchronize_session=False)
+    db.session.execute(db.update(User).where(User.id == user_id).values(**data_version_bump())
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+    return len(hot)
+
+def archive_purchases(today=None):
+    """Archive every (user, month) of the current database older than the horizon.
+
+    One transaction per user and month, so the hot table is never locked for
+    long; safe to rerun. Returns the run statistics.
+    """
+    stats = {'users': 0, 'months': 0, 'purchases': 0}
+    horizon = archive_horizon(today or date.today())
+    if horizon is None:
+        return stats
+    month = db.func.strftime('%Y-%m-01', Purchase.date)
+    groups = db.session.query(Purchase.user_id, month).filter(
+        Purchase.date < datetime.combine(horizon, datetime.min.time())
+    ).distinct().order_by(Purchase.user_id, month).all()
+    for user_id, m in groups:
+        stats['purchases'] += archive_month(user_id, date.fromisoformat(m))
+        stats['months'] += 1
+    stats['users'] = len({user_id for user_id, _ in groups})
+    return stats
+
+def archive_all_purchases(today=None):
+    # archive_purchases on the main database and every shard
+    stats = {'users': 0, 'months': 0, 'purchases': 0}
+    for _, location_stats in for_each_location(lambda: archive_purchases(today)):
+        for stat, value in location_stats.items():
+            stats[stat] += value
+    print(f"Archive run: {stats}")
+    return stats
+
+# -------------------- Analytics --------------------
+class PurchaseSeries:
+    """A user's purchase history as column arrays: day number, price and category code.
+
+    Rows are only ever appended (in any date order); every statistic is computed
+    with bincount/cumsum over these arrays, so nothing depends on row order.
+    """
+
+    def __init__(self):
+        import numpy as np
+        self.size = 0
+        self.days = np.empty(64, dtype=np.int32)  # days since 1970-01-01
+        self.prices = np.empty(64, dtype=np.float64)
+        self.codes = np.empty(64, dtype=np.int32)
+        self.categories = ['-']  # code 0 = no category
+        self.category_codes = {None: 0, '': 0}
+        self.max_id = 0
+        self.total = 0.0
+
+    def append(self, rows):
+        # rows: [(id, date, price_dz, category)]
+        import numpy as np
+        n = len(rows)
+        if not n:
+            return
+        if self.size + n > len(self.days):
+            capacity = max(self.size + n, 2 * len(self.days))
+            for name in ('days', 'prices', 'codes'):
+                grown = np.empty(capacity, dtype=getattr(self, name).dtype)
+                grown[:self.size] = getattr(self, name)[:self.size]
+                setattr(self, name, grown)
+        ids, dates, prices, cats = zip(*rows)
+        end = self.size + n
+        self.days[self.size:end] = np.array(dates, dtype='datetime64[s]').astype('datetime64[D]').astype(np.int32)
+        self.prices[self.size:end] = prices
+        self.codes[self.size:end] = [self.category_code(c) for c in cats]
+        self.size = end
+        self.max_id = max(self.max_id, max(ids))
+        self.total += float(np.sum(prices))
+
+    def category_code(self, category):
+        code = self.category_codes.get(category)
+        if code is None:
+            code = self.category_codes[category] = len(self.categories)
+            self.categories.append(category)
+        return code
+
+    def version(self):
+        return purchase_set_version(self.size, self.total, self.max_id)
+
+    def columns(self):
+        return self.days[:self.size], self.prices[:self.size], self.codes[:self.size]
+
+_analytics_cache = OrderedDict()
+_analytics_lock = threading.Lock()
+ANALYTICS_COLUMNS = (Purchase.id, Purchase.date, Purchase.price_dz, Purchase.category)
+
+def purchase_history_version(user_id):
+    # same fingerprint as purchase_set_version, over the user's whole history
+    if archive_in_use():
+        # the hot table then only holds the recent months: its rows plus the archive's pre-computed totals
+        count, total, max_id = db.session.query(
+            db.func.count(Purchase.id),
+            db.func.coalesce(db.func.sum(Purchase.price_dz), 0.0),
+            db.func.coalesce(db.func.max(Purchase.id), 0)
+        ).filter(Purchase.user_id == user_id).one()
+        archived_count, archived_total, archived_max = archive_totals(user_id)
+        count, total, max_id = count + archived_count, total + archived_total, max(max_id, archived_max)
+    else:
+        total, count = db.session.query(
+            db.func.coalesce(db.func.sum(DailyCategoryTotal.total_dz), 0.0),
+            db.func.coalesce(db.func.sum(DailyCategoryTotal.count), 0)
+        ).filter(DailyCategoryTotal.user_id == user_id).one()
+        max_id = db.session.query(db.func.max(Purchase.id)).filter(Purchase.user_id == user_id).scalar() or 0
+    return purchase_set_version(count, total, max_id), max_id
+
+def load_purchase_series(user_id):
+    """Cached PurchaseSeries of a user, brought up to date with the database.
+
+    New rows (e.g. added by another worker) are fetched by id and appended;
+    a full reload only happens when purchases were deleted or repriced.
+    """
+    version, max_id = purchase_history_version(user_id)
+    with _analytics_lock:
+        series = _analytics_cache.get(user_id)
+        if series is not None:
+            _analytics_cache.move_to_end(user_id)
+    if series is not None and series.version() == version:
+        return series
+    if series is not None and series.max_id < max_id:
+        tail = db.session.query(*ANALYTICS_COLUMNS).filter(
+            Purchase.user_id == user_id, Purchase.id > series.max_id
+        ).all()
+        with _analytics_lock:
+            series.append(tail)
+        if series.version() == version:
+            return series
+    series = PurchaseSeries()
+    series.append([(p.id, p.date, p.price_dz, p.category) for p in archived_purchases(user_id)])
+    series.append(db.session.query(*ANALYTICS_COLUMNS).filter(Purchase.user_id == user_id).all())
+    with _analytics_lock:
+        _analytics_cache[user_id] = series
+        _analytics_cache.move_to_end(user_id)
+        while len(_analytics_cache) > ANALYTICS_CACHE_SIZE:
+            _analytics_cache.popitem(last=False)
+    return series
+
+def analytics_append(user_id, rows):
+    # incrementally extend a cached series after a write; uncached users load on demand
+    with _analytics_lock:
+        series = _analytics_cache.get(user_id)
+        if series is not None:
+            series.append(rows)
+
+def day_number(d: date):
+    import numpy as np
+    return int(np.datetime64(d, 'D').astype(np.int64))
+
+def compute_analytics(series, start: date, end: date):
+    """Category breakdown, rolling averages, month-over-month and a month-end forecast."""
+    import numpy as np
+    days, prices, codes = series.columns()
+    first, last = day_number(start), day_number(end)
+    in_range = (days >= first) & (days <= last)
+
+    by_category = np.bincount(codes[in_range], weights=prices[in_range], minlength=len(series.categories))
+    counts = np.bincount(codes[in_range], minlength=len(series.categories))
+
+    # daily totals from 29 days before start, so the 30-day window is full on day one
+    lead = 29
+    window = (days >= first - lead) & (days <= last)
+    daily = np.bincount(days[window] - (first - lead), weights=prices[window], minlength=last - first + 1 + lead)
+    csum = np.concatenate(([0.0], np.cumsum(daily)))
+    idx = np.arange(lead, len(daily)) + 1
+    avg_7 = (csum[idx] - csum[idx - 7]) / 7
+    avg_30 = (csum[idx] - csum[idx - 30]) / 30
+    dates = np.arange(first, last + 1).astype('datetime64[D]')
+
+    # month-over-month over the whole history up to end
+    upto = days <= last
+    months = days[upto].astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    monthly, month_keys = np.zeros(0), np.zeros(0, dtype=np.int64)
+    if months.size:
+        month_keys = np.arange(months.min(), months.max() + 1)
+        monthly = np.bincount(months - months.min(), weights=prices[upto])
+    deltas = np.diff(monthly, prepend=np.nan)
+    prev = np.concatenate(([np.nan], monthly[:-1]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct = np.where(prev > 0, deltas / prev * 100, np.nan)
+
+    # linear fit of cumulative spend against day of month, evaluated at month end
+    first_of_month = np.datetime64(end, 'M').astype('datetime64[D]')
+    month_days = int(((first_of_month.astype('datetime64[M]') + 1).astype('datetime64[D]') - first_of_month).astype(int))
+    elapsed = last - int(first_of_month.astype(np.int64)) + 1
+    this_month = (days >= last - elapsed + 1) & upto
+    spent = np.bincount(days[this_month] - (last - elapsed + 1), weights=prices[this_month], minlength=elapsed)
+    cumulative = np.cumsum(spent)
+    if elapsed >= 2:
+        slope, intercept = np.polyfit(np.arange(1, elapsed + 1), cumulative, 1)
+        projected = max(float(slope * month_days + intercept), float(cumulative[-1]))
+    else:
+        projected = float(cumulative[-1]) * month_days
+
+    def num(x):
+        return None if np.isnan(x) else round(float(x), 2)
+
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'total': round(float(prices[in_range].sum()), 2),
+        'count': int(in_range.sum()),
+        'by_category': [
+            {'category': series.categories[c], 'total': round(float(by_category[c]), 2), 'count': int(counts[c])}
+            for c in np.argsort(-by_category) if counts[c]
+        ],
+        'daily': [
+            {'date': str(d), 'total': round(float(t), 2), 'avg_7': round(float(a7), 2), 'avg_30': round(float(a30), 2)}
+            for d, t, a7, a30 in zip(dates, daily[lead:], avg_7, avg_30)
+        ],
+        'monthly': [
+            {'month': str(np.datetime64(int(m), 'M')), 'total': round(float(t), 2), 'delta': num(d), 'delta_pct': num(p)}
+            for m, t, d, p in zip(month_keys, monthly, deltas, pct)
+        ],
+        'forecast': {
+            'month': str(np.datetime64(end, 'M')),
+            'spent': round(float(cumulative[-1]), 2),
+            'days_elapsed': elapsed,
+            'days_in_month': month_days,
+            'projected_total': round(projected, 2)
+        }
+    }
+
+# -------------------- Email outbox --------------------
+
+def enqueue_email(to_email, subject, body, pdf_data: bytes = None, pdf_filename='report.pdf'):
+    """Add a message to the outbox; it is durable once the caller commits."""
+    msg = EmailOutbox(to_email=to_email, subject=subject, body=body,
+                      attachment=pdf_data, attachment_name=pdf_filename)
+    db.session.add(msg)
+    return msg
+
+def smtp_send_batch(messages):
+    """Send [(id, EmailMessage)] over as few SMTP sessions as possible.
+
+    Runs on a delivery thread without DB access; returns {id: error or None}.
+    A session is reused for up to SMTP_MESSAGES_PER_CONNECTION messages and
+    reopened once if the server drops it. If no session can be opened, the
+    remaining messages all fail with that error.
+    """
+    import smtplib
+    results = {}
+    smtp = None
+    sent_on_conn = 0
+
+    def close():
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
+
+    try:
+        for i, (msg_id, msg) in enumerate(messages):
+            for attempt in (1, 2):
+                if smtp is None or sent_on_conn >= SMTP_MESSAGES_PER_CONNECTION:
+                    if smtp is not None:
+                        close()
+                        smtp = None
+                    try:
+                        smtp, sent_on_conn = open_smtp(), 0
+                    except Exception as e:
+                        error = str(e) or e.__class__.__name__
+                        results.update((mid, error) for mid, _ in messages[i:])
+                        return results
+                try:
+                    started = time.perf_counter()
+                    smtp.send_message(msg)
+                    SMTP_SEND_SECONDS.observe(time.perf_counter() - started, path='outbox')
+                    sent_on_conn += 1
+                    results[msg_id] = None
+                    break
+                except Exception as e:
+                    SMTP_ERRORS.inc(path='outbox')
+                    dropped = isinstance(e, smtplib.SMTPServerDisconnected) or \
+                        (isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException))
+                    if dropped:
+                        smtp.close()
+                        smtp = None
+                    if not dropped or attempt == 2:
+                        # a rejected recipient/message leaves the session usable
+                        results[msg_id] = str(e) or e.__class__.__name__
+                        break
+    finally:
+        if smtp is not None:
+            close()
+    return results
+
+def claim_outbox(limit):
+    # mark due messages as ours so concurrent workers don't send them twice
+    now = datetime.utcnow()
+    token = uuid.uuid4().hex
+    due = db.session.query(EmailOutbox.id).filter(
+        db.or_(
+            db.and_(EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now),
+            db.and_(EmailOutbox.status == 'sending', EmailOutbox.claimed_at < now - OUTBOX_CLAIM_TIMEOUT)
+        )
+    ).order_by(EmailOutbox.next_attempt_at).limit(limit).scalar_subquery()
+    EmailOutbox.query.filter(EmailOutbox.id.in_(due)).update(
+        {'status': 'sending', 'claim_token': token, 'claimed_at': now},
+        synchronize_session=False
+    )
+    db.session.commit()
+    return EmailOutbox.query.filter_by(claim_token=token, status='sending').all()
+
+def deliver_outbox(batch_size=OUTBOX_BATCH_SIZE):
+    """Drain due outbox messages over SMTP_POOL_SIZE reused SMTP sessions.
+
+    Failed messages are retried with exponential backoff and marked 'failed'
+    after OUTBOX_MAX_ATTEMPTS. Returns {'sent': n, 'retry': n, 'failed': n}.
+    """
+    counts = {'sent': 0, 'retry': 0, 'failed': 0}
+    while True:
+        claimed = claim_outbox(batch_size)
+        if not claimed:
+            return counts
+        by_id = {m.id: m for m in claimed}
+        prepared = [(m.id, build_email(m.to_email, m.subject, m.body, m.attachment, m.attachment_name))
+                    for m in claimed]
+        workers = max(1, min(SMTP_POOL_SIZE, len(prepared)))
+        chunks = [prepared[i::workers] for i in range(workers)]
+        results = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for res in pool.map(smtp_send_batch, chunks):
+                results.update(res)
+        now = datetime.utcnow()
+        for msg_id, error in results.items():
+            m = by_id[msg_id]
+            m.claim_token = None
+            if error is None:
+                m.status, m.sent_at, m.last_error = 'sent', now, None
+                counts['sent'] += 1
+                continue
+            m.attempts += 1
+            m.last_error = error
+            if m.attempts >= OUTBOX_MAX_ATTEMPTS:
+                m.status = 'failed'
+                counts['failed'] += 1
+                print(f"Email to {m.to_email} failed after {m.attempts} attempts: {error}")
+            else:
+                m.status = 'pending'
+                m.next_attempt_at = now + timedelta(seconds=OUTBOX_BACKOFF_SECONDS * 2 ** (m.attempts - 1))
+                counts['retry'] += 1
+        db.session.commit()
+        if len(claimed) < batch_size:
+            return counts
+
+# -------------------- Write queue --------------------
+
+class WriteQueue:
+    """Single writer thread that groups small transactions into one commit.
+
+    Each job is a function doing ORM work on db.session (in the writer's app
+    context) and returning a plain value. Jobs waiting at the same time are
+    run back to back and committed together; if that commit fails, the batch
+    is replayed one job per transaction so only the failing job gets its error.
+    Each queue writes to one database (`shard`, None = main).
+    """
+
+    def __init__(self, shard=None, max_batch=WRITE_QUEUE_MAX_BATCH, max_delay=WRITE_QUEUE_MAX_DELAY):
+        self.shard = shard
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.jobs = deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.batches = 0
+        self.jobs_done = 0
+
+    def submit(self, fn) -> Future:
+        fut = Future()
+        with self.cond:
+            if self.thread is None:
+                name = 'write-queue' if self.shard is None else f'write-queue-shard{self.shard}'
+                self.thread = threading.Thread(target=self.run, args=(current_app._get_current_object(),),
+                                               name=name, daemon=True)
+                self.thread.start()
+            self.jobs.append((fn, fut))
+            self.cond.notify()
+        return fut
+
+    def take_batch(self):
+        with self.cond:
+            while not self.jobs:
+                self.cond.wait()
+            deadline = time.monotonic() + self.max_delay
+            while len(self.jobs) < self.max_batch and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+            return [self.jobs.popleft() for _ in range(min(self.max_batch, len(self.jobs)))]
+
+    def run(self, app):
+        with app.app_context(), use_shard(self.shard):
+            while True:
+                batch = self.take_batch()
+                try:
+                    results = [fn() for fn, _ in batch]
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    results = None
+                if results is None:
+                    for fn, fut in batch:
+                        try:
+                            result = fn()
+                            db.session.commit()
+                            fut.set_result(result)
+                        except Exception as e:
+                            db.session.rollback()
+                            fut.set_exception(e)
+                else:
+                    for (_, fut), result in zip(batch, results):
+                        fut.set_result(result)
+                db.session.remove()
+                self.batches += 1
+                self.jobs_done += len(batch)
+
+# one writer per database, so a batch never holds locks on two files and shards commit in parallel
+write_queues = {shard: WriteQueue(shard) for shard in shard_locations()}
+
+def run_write(fn):
+    """Run `fn` (ORM writes on db.session) and commit; returns fn's result.
+
+    With WRITE_QUEUE=1 the work is handed to the writer thread of the
+    request's shard and may share its commit with other requests; otherwise
+    it commits in this thread.
+    """
+    if not WRITE_QUEUE_ENABLED:
+        result = fn()
+        db.session.commit()
+        return result
+    return write_queues[current_shard()].submit(fn).result()
+
+# -------------------- Report jobs --------------------
+class ReportQueueFull(Exception):
+    pass
+
+_report_job_pool = ThreadPoolExecutor(max_workers=REPORT_JOB_WORKERS, thread_name_prefix='report-job')
+# يحد عدد المهام المنفذة + المنتظرة في هذه العملية
+_report_job_slots = threading.BoundedSemaphore(REPORT_JOB_WORKERS + REPORT_JOB_MAX_QUEUE)
+
+def report_job_key(user_id, rtype, start, end, send_email, email, data_version):
+    # identical requests over unchanged data share one in-flight job
+    return make_etag('report-job', user_id, rtype, start, end, bool(send_email), email or '', data_version)
+
+def submit_report_job(app, job_id):
+    """Hand a queued job to the bounded pool; raises ReportQueueFull when it is saturated."""
+    if not _report_job_slots.acquire(blocking=False):
+        raise ReportQueueFull()
+
+    def task():
+        try:
+            process_report_job(app, job_id)
+        finally:
+            _report_job_slots.release()
+
+    _report_job_pool.submit(task)
+
+def process_report_job(app, job_id):
+    """Render one job, log it in ReportLog and queue its email; never raises.
+
+    The job is claimed with a conditional UPDATE, so a job resubmitted by the
+    recovery sweep while it is still running is not processed twice. The email
+    (main database) and the ReportLog (user's shard) commit first under the
+    job's idempotency key, then the job is marked done: a job that died between
+    these commits is rerun by the sweep without a second email or log row.
+    """
+    with app.app_context():
+        try:
+            claimed = ReportJob.query.filter_by(id=job_id, status='queued').update(
+                {'status': 'running', 'started_at': datetime.utcnow()}, synchronize_session=False
+            )
+            db.session.commit()
+            if not claimed:
+                return
+            job = db.session.get(ReportJob, job_id)
+            try:
+                # the user's rows and its ReportLog are on the user's shard; the job and outbox stay in main
+                with user_shard(job.user_id):
+                    user = ReportUser(*db.session.query(User.id, User.name, User.email).filter(User.id == job.user_id).one())
+                    version, total, pdf_bytes, pdf_file = build_report(user, job.report_type, job.start_date, job.end_date)
+                    if pdf_file is not None:
+                        with pdf_file:
+                            pdf_bytes = pdf_file.read() if job.send_email else None
+                    key = report_job_idempotency_key(job.id)
+                    if job.send_email:
+                        subject, body = report_email(job.report_type, job.start_date, job.end_date, total)
+                        email = {
+                            'to_email': job.email or user.email, 'subject': subject, 'body': body,
+                            'attachment': pdf_bytes, 'idempotency_key': key,
+                            'attachment_name': f"report_{job.report_type}_{job.start_date}_{job.end_date}.pdf",
+                        }
+                        db.session.execute(sqlite_insert(EmailOutbox).on_conflict_do_nothing(index_elements=['idempotency_key']), [email])
+                        db.session.commit()
+                    log = ReportLog.query.filter_by(idempotency_key=key).first()
+                    if log is None:
+                        log = ReportLog(user_id=job.user_id, report_type=job.report_type, total=total,
+                                        start_date=job.start_date, end_date=job.end_date, idempotency_key=key)
+                        db.session.add(log)
+                        db.session.commit()
+                    log_id = log.id
+                ReportJob.query.filter_by(id=job_id, status='running').update({
+                    'status': 'done', 'version': version, 'total': total, 'report_log_id': log_id,
+                    'finished_at': datetime.utcnow(),
+                }, synchronize_session=False)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Report job {job_id} failed: {e}")
+                ReportJob.query.filter_by(id=job_id).update(
+                    {'status': 'failed', 'error': str(e) or e.__class__.__name__, 'finished_at': datetime.utcnow()},
+                    synchronize_session=False
+                )
+                db.session.commit()
+                return
+            if job.send_email:
+                # the message is durable in the outbox; this only saves waiting for the next poll
+                try:
+                    deliver_outbox()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Outbox delivery after report job {job_id} failed: {e}")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Report job {job_id} could not run: {e}")
+        finally:
+            db.session.remove()
+
+def resume_report_jobs(app):
+    """Resubmit jobs left queued or running by a dead process and drop expired ones."""
+    now = datetime.utcnow()
+    ReportJob.query.filter(
+        ReportJob.status == 'running', ReportJob.started_at < now - REPORT_JOB_STALE
+    ).update({'status': 'queued'}, synchronize_session=False)
+    purged = ReportJob.query.filter(
+        ReportJob.status.in_(('done', 'failed')), ReportJob.finished_at < now - REPORT_JOB_RETENTION
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    stale = [job_id for job_id, in db.session.query(ReportJob.id).filter(
+        ReportJob.status == 'queued', ReportJob.created_at < now - REPORT_JOB_STALE
+    )]
+    resumed = 0
+    for job_id in stale:
+        try:
+            submit_report_job(app, job_id)
+        except ReportQueueFull:
+            break
+        resumed += 1
+    return {'resumed': resumed, 'purged': purged}
+
+def report_job_to_dict(job):
+    d = {
+        'id': job.id,
+        'status': job.status,
+        'type': job.report_type,
+        'start': job.start_date.isoformat(),
+        'end': job.end_date.isoformat(),
+        'send_email': job.send_email,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at and job.finished_at.isoformat(),
+    }
+    if job.status == 'done':
+        d['total'] = job.total
+        d['download_url'] = f"/reports/{job.id}?download=1"
+    if job.status == 'failed':
+        d['error'] = job.error
+    return d
 
 # -------------------- Routes --------------------
 
-@app.route('/register', methods=['POST'])
+@bp.app_errorhandler(PasswordPoolBusy)
+def password_pool_busy(e):
+    resp = jsonify({'message': 'server busy, retry later'})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = str(PASSWORD_HASH_RETRY_AFTER)
+    return resp
+
+@bp.app_errorhandler(ReportQueueFull)
+def report_queue_full(e):
+    resp = jsonify({'message': 'too many reports in progress, retry later'})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = str(REPORT_JOB_RETRY_AFTER)
+    return resp
+
+@bp.route('/register', methods=['POST'])
 def register():
     data = request.json
     if not data or not data.get('email') or not data.get('password'):
@@ -142,10 +1961,15 @@ def register():
     )
     user.set_password(data['password'])
     db.session.add(user)
+    db.session.flush()
+    assign_shard(user)
+    with user_shard(user.id):
+        db.session.add(BalanceLedger(user_id=user.id, amount=user.balance_dz, reason='opening'))
+        db.session.flush()
     db.session.commit()
     return jsonify({'message': 'registered successfully'})
 
-@app.route('/login', methods=['POST'])
+@bp.route('/login', methods=['POST'])
 def login():
     data = request.json
     if not data or not data.get('email') or not data.get('password'):
@@ -154,108 +1978,457 @@ def login():
     if not user or not user.check_password(data['password']):
         return jsonify({'message': 'invalid credentials'}), 401
     token = jwt.encode({'id': user.id, 'exp': datetime.utcnow() + timedelta(days=7)}, JWT_SECRET, algorithm='HS256')
+    balance = user.balance_dz
+    if SHARD_COUNT:
+        with user_shard(user.id):
+            balance = db.session.query(User.balance_dz).filter(User.id == user.id).scalar()
     return jsonify({
         'token': token,
         'user': {
             'id': user.id,
             'name': user.name,
             'email': user.email,
-            'balance_dz': user.balance_dz
+            'balance_dz': balance
         }
     })
 
-@app.route('/add_purchase', methods=['POST'])
+@bp.route('/add_purchase', methods=['POST'])
 @token_required
 def add_purchase(current_user):
     data = request.json
     try:
-        item_name = data['item_name']
-        price_dz = float(data['price_dz'])
-        category = data.get('category', None)
-        dt_str = data.get('date')
-        if dt_str:
-            dt = datetime.strptime(dt_str, '%Y-%m-%d')
-        else:
-            dt = datetime.utcnow()
+        fields = parse_purchase(data)
     except Exception as e:
         return jsonify({'message': 'invalid data'}), 400
-    p = Purchase(user_id=current_user.id, item_name=item_name, price_dz=price_dz, category=category, date=dt)
-    current_user.balance_dz -= price_dz
-    db.session.add(p)
-    db.session.commit()
-    return jsonify({'message': 'purchase added', 'balance_dz': current_user.balance_dz})
+    def write():
+        p = Purchase(user_id=current_user.id, **fields)
+        db.session.add(p)
+        db.session.flush()
+        apply_to_aggregates([p])
+        return p.id, adjust_balance(current_user.id, -p.price_dz, 'purchase', p.id)
 
-@app.route('/purchases', methods=['GET'])
+    purchase_id, balance = run_write(write)
+    cache_user(current_user._replace(balance_dz=balance))
+    analytics_append(current_user.id, [(purchase_id, fields['date'], fields['price_dz'], fields['category'])])
+    return jsonify({'message': 'purchase added', 'balance_dz': balance})
+
+@bp.route('/add_purchases', methods=['POST'])
+@token_required
+def add_purchases(current_user):
+    # expects: { "purchases": [ {item_name, price_dz, category, date}, ... ] }
+    data = request.json
+    items = data.get('purchases') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify({'message': 'purchases list required'}), 400
+    if len(items) > ADD_PURCHASES_MAX_BATCH:
+        return jsonify({'message': f'at most {ADD_PURCHASES_MAX_BATCH} purchases per request'}), 413
+    rows = []
+    failed = []
+    for i, item in enumerate(items):
+        try:
+            fields = parse_purchase(item)
+        except Exception as e:
+            failed.append({'index': i, 'message': 'invalid data', 'error': str(e)})
+            continue
+        fields['user_id'] = current_user.id
+        rows.append(fields)
+    if not rows:
+        return jsonify({'message': 'no valid purchases', 'inserted': 0, 'failed': failed}), 400
+    # one executemany INSERT, one balance update, one commit
+    def write():
+        db.session.execute(db.insert(Purchase), rows)
+        apply_to_aggregates(rows)
+        return adjust_balance(current_user.id, -sum(r['price_dz'] for r in rows), 'batch')
+
+    balance = run_write(write)
+    cache_user(current_user._replace(balance_dz=balance))
+    return jsonify({
+        'message': 'purchases added',
+        'inserted': len(rows),
+        'failed': failed,
+        'balance_dz': balance
+    })
+
+@bp.route('/purchases', methods=['GET'])
 @token_required
 def get_purchases(current_user):
+    # optional query params: start, end (YYYY-MM-DD), limit, cursor, stream=ndjson|json
+    version, last_modified = user_data_version(current_user.id)
+    etag = make_etag('purchases', current_user.id, version, request.query_string.decode())
+    cached = not_modified(etag, last_modified)
+    if cached is not None:
+        return cached
+    resp = make_response(list_purchases(current_user))
+    if resp.status_code != 200:
+        return resp
+    return with_validators(resp, etag, last_modified)
+
+def list_purchases(current_user):
     start = request.args.get('start')
     end = request.args.get('end')
-    q = Purchase.query.filter_by(user_id=current_user.id)
+    sdt = edt = None
+    q = db.session.query(*PURCHASE_COLUMNS).filter(Purchase.user_id == current_user.id)
     if start:
         sdt = datetime.strptime(start, '%Y-%m-%d')
         q = q.filter(Purchase.date >= sdt)
     if end:
         edt = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1)
         q = q.filter(Purchase.date < edt)
-    purchases = q.order_by(Purchase.date.desc()).all()
-    out = []
-    for p in purchases:
-        out.append({
-            'id': p.id,
-            'item_name': p.item_name,
-            'price_dz': p.price_dz,
-            'category': p.category,
-            'date': p.date.strftime('%Y-%m-%d')
-        })
-    return jsonify(out)
+    q = q.order_by(Purchase.date.desc(), Purchase.id.desc())
 
-@app.route('/generate_report', methods=['POST'])
+    stream = request.args.get('stream')
+    if stream:
+        if stream not in ('ndjson', 'json'):
+            return jsonify({'message': 'stream must be ndjson or json'}), 400
+        rows = with_archive(q.yield_per(STREAM_BATCH_SIZE), current_user.id, sdt, edt, newest_first=True)
+        return stream_purchases(rows, stream)
+
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    if limit is None and cursor is None:
+        # legacy response: the whole (filtered) history as a JSON array
+        rows = with_archive(q.all(), current_user.id, sdt, edt, newest_first=True)
+        return jsonify([purchase_to_dict(p) for p in rows])
+
+    try:
+        limit = min(int(limit or PURCHASES_PAGE_SIZE), PURCHASES_MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError(limit)
+    except ValueError:
+        return jsonify({'message': 'invalid limit'}), 400
+    key = None
+    if cursor:
+        try:
+            key = decode_cursor(cursor)
+            q = keyset_after(q, key)
+        except Exception:
+            return jsonify({'message': 'invalid cursor'}), 400
+    hot = q.limit(limit + 1).all()
+    # a full page of hot rows only needs archived rows at least as new as its last one, usually none
+    floor = hot[limit].date if len(hot) > limit else sdt
+    rows = list(islice(with_archive(hot, current_user.id, floor, edt, newest_first=True, after=key), limit + 1))
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return jsonify({
+        'purchases': [purchase_to_dict(p) for p in rows[:limit]],
+        'next_cursor': next_cursor
+    })
+
+@bp.route('/purchases/search', methods=['GET'])
+@token_required
+def search_purchases(current_user):
+    # query params: q (words matched against item name and category, word* for a prefix), optional start, end, limit, cursor
+    # only the hot table is indexed: with ARCHIVE_AFTER_MONTHS set (off by default), archived purchases are not searched
+    try:
+        match = fts_match(request.args.get('q', ''), current_user.id)
+    except ValueError:
+        return jsonify({'message': 'q is required'}), 400
+    q = search_query(current_user.id, match)
+    try:
+        if request.args.get('start'):
+            q = q.filter(Purchase.date >= datetime.strptime(request.args['start'], '%Y-%m-%d'))
+        if request.args.get('end'):
+            q = q.filter(Purchase.date < datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1))
+        limit = min(int(request.args.get('limit') or PURCHASES_PAGE_SIZE), PURCHASES_MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError(limit)
+    except ValueError:
+        return jsonify({'message': 'invalid date or limit'}), 400
+    q = q.order_by(Purchase.date.desc(), Purchase.id.desc())
+    if request.args.get('cursor'):
+        try:
+            q = keyset_after(q, decode_cursor(request.args['cursor']))
+        except Exception:
+            return jsonify({'message': 'invalid cursor'}), 400
+    rows = q.limit(limit + 1).all()
+    return jsonify({
+        'purchases': [purchase_to_dict(p) for p in rows[:limit]],
+        'next_cursor': encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    })
+
+@bp.route('/export', methods=['GET'])
+@token_required
+def export_purchases(current_user):
+    # query params: format=csv|ndjson (default csv), optional start, end (YYYY-MM-DD)
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'message': 'format must be csv or ndjson'}), 400
+    q = db.session.query(*PURCHASE_COLUMNS).filter(Purchase.user_id == current_user.id)
+    sdt = edt = None
+    try:
+        if request.args.get('start'):
+            sdt = datetime.strptime(request.args['start'], '%Y-%m-%d')
+            q = q.filter(Purchase.date >= sdt)
+        if request.args.get('end'):
+            edt = datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1)
+            q = q.filter(Purchase.date < edt)
+    except ValueError:
+        return jsonify({'message': 'invalid date'}), 400
+    rows = with_archive(q.order_by(Purchase.date, Purchase.id).yield_per(STREAM_BATCH_SIZE), current_user.id, sdt, edt)
+    resp = stream_purchases(rows, fmt)
+    resp.headers['Content-Disposition'] = f'attachment; filename=purchases_{current_user.id}.{fmt}'
+    return resp
+
+@bp.route('/import', methods=['POST'])
+@token_required
+def import_purchases(current_user):
+    """Import purchases from a CSV upload (raw body or multipart field 'file').
+
+    Columns: item_name, price_dz, and optionally category and date (YYYY-MM-DD),
+    as written by /export. The upload is spooled to a temp file first and parsed
+    and validated outside any transaction, into IMPORT_CHUNK_SIZE batches on a
+    second temp file. Only the bulk inserts and the single balance adjustment at
+    the end run in the write transaction. Bad rows are reported by line number.
+    """
+    source = request.files['file'].stream if 'file' in request.files else request.stream
+    try:
+        upload = spool_upload(source, IMPORT_MAX_BYTES)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 413
+    inserted, spent, error_count = 0, 0.0, 0
+    errors = []
+    with upload, tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as batches:
+        reader = csv.DictReader(io.TextIOWrapper(upload, encoding='utf-8-sig', newline=''))
+        chunk = []
+        try:
+            # reading fieldnames decodes the header line, so it can fail like any other row
+            if not reader.fieldnames or not {'item_name', 'price_dz'} <= set(reader.fieldnames):
+                return jsonify({'message': 'CSV header must include item_name and price_dz'}), 400
+            # first pass: nothing is written to the DB yet, so other writers are not held up
+            for row in reader:
+                try:
+                    fields = parse_purchase(row)
+                except Exception as e:
+                    error_count += 1
+                    if len(errors) < IMPORT_MAX_ERRORS:
+                        errors.append({'line': reader.line_num, 'message': 'invalid data', 'error': str(e)})
+                    continue
+                fields['category'] = fields['category'] or None
+                fields['user_id'] = current_user.id
+                chunk.append(fields)
+                spent += fields['price_dz']
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    pickle.dump(chunk, batches)
+                    chunk = []
+        except (UnicodeDecodeError, csv.Error) as e:
+            return jsonify({'message': 'unreadable CSV', 'error': str(e), 'line': reader.line_num}), 400
+        if chunk:
+            pickle.dump(chunk, batches)
+        # second pass: the write transaction only replays the validated batches
+        end = batches.tell()
+        batches.seek(0)
+        while batches.tell() < end:
+            chunk = pickle.load(batches)
+            db.session.execute(db.insert(Purchase), chunk)
+            apply_to_aggregates(chunk)
+            inserted += len(chunk)
+        balance = adjust_balance(current_user.id, -spent, 'import') if inserted else current_user.balance_dz
+        db.session.commit()
+    if inserted:
+        cache_user(current_user._replace(balance_dz=balance))
+    return jsonify({
+        'message': 'import finished',
+        'inserted': inserted,
+        'failed': error_count,
+        'errors': errors,
+        'balance_dz': balance
+    }), 200 if inserted or not error_count else 400
+
+@bp.route('/summary', methods=['GET'])
+@token_required
+def get_summary(current_user):
+    # optional query params: start, end (YYYY-MM-DD); defaults to the current month
+    today = date.today()
+    try:
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d').date() if request.args.get('start') else date(today.year, today.month, 1)
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if request.args.get('end') else today
+    except ValueError:
+        return jsonify({'message': 'invalid date'}), 400
+    weekly, monthly, by_category = {}, {}, {}
+    total, count = 0.0, 0
+    for day, category, day_total, day_count in daily_totals(current_user.id, start, end):
+        wk = week_start(day).isoformat()
+        mo = day.strftime('%Y-%m')
+        cat = category or '-'
+        weekly[wk] = weekly.get(wk, 0.0) + day_total
+        monthly[mo] = monthly.get(mo, 0.0) + day_total
+        by_category[cat] = by_category.get(cat, 0.0) + day_total
+        total += day_total
+        count += day_count
+    return jsonify({
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'total': total,
+        'count': count,
+        'weekly': [{'week_start': k, 'total': v} for k, v in sorted(weekly.items())],
+        'monthly': [{'month': k, 'total': v} for k, v in sorted(monthly.items())],
+        'by_category': by_category
+    })
+
+@bp.route('/analytics', methods=['GET'])
+@token_required
+def get_analytics(current_user):
+    # optional query params: start, end (YYYY-MM-DD); defaults to the last 90 days
+    today = date.today()
+    try:
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if request.args.get('end') else today
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d').date() if request.args.get('start') else end - timedelta(days=89)
+    except ValueError:
+        return jsonify({'message': 'invalid date'}), 400
+    if start > end:
+        return jsonify({'message': 'start must be before end'}), 400
+    if (end - start).days >= ANALYTICS_MAX_DAYS:
+        return jsonify({'message': f'the range can cover at most {ANALYTICS_MAX_DAYS} days'}), 400
+    return jsonify(compute_analytics(load_purchase_series(current_user.id), start, end))
+
+@bp.route('/balance', methods=['GET'])
+@token_required
+def get_balance(current_user):
+    # optional query param: at (YYYY-MM-DD) -> balance at the end of that day
+    at = request.args.get('at')
+    if not at:
+        balance = db.session.query(User.balance_dz).filter(User.id == current_user.id).scalar()
+        return jsonify({'balance_dz': balance})
+    try:
+        when = datetime.combine(datetime.strptime(at, '%Y-%m-%d').date(), datetime.max.time())
+    except ValueError:
+        return jsonify({'message': 'invalid date'}), 400
+    return jsonify({'at': at, 'balance_dz': balance_at(current_user.id, when)})
+
+@bp.route('/generate_report', methods=['POST'])
 @token_required
 def generate_report(current_user):
+    # expects: { "type": "weekly" | "monthly" | "custom", "start", "end" (custom only), "send_email", "email" }
     data = request.json
     rtype = data.get('type', 'weekly')
-    today = date.today()
-    if rtype == 'weekly':
-        start = today - timedelta(days=today.weekday() + 1)
-        end = start + timedelta(days=6)
-    else:
-        start = date(today.year, today.month, 1)
-        if today.month == 12:
-            end = date(today.year, 12, 31)
-        else:
-            end = date(today.year, today.month + 1, 1) - timedelta(days=1)
-    purchases = Purchase.query.filter(
-        Purchase.user_id == current_user.id,
-        Purchase.date >= datetime.combine(start, datetime.min.time()),
-        Purchase.date <= datetime.combine(end, datetime.max.time())
-    ).order_by(Purchase.date).all()
-    pdf_buf, total = generate_pdf_report(current_user, purchases, title=f"تقرير ({rtype})")
-    rl = ReportLog(user_id=current_user.id, report_type=rtype, total=total, start_date=start, end_date=end)
-    db.session.add(rl)
-    db.session.commit()
+    try:
+        start, end = report_window(rtype, data, date.today())
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    filename = f"report_{rtype}_{start}_{end}.pdf"
     send_flag = data.get('send_email', False)
+    if not send_flag:
+        # a client that already holds this download gets a 412 (POST, so not a 304) before anything is rendered
+        data_version, last_modified = user_data_version(current_user.id)
+        etag = make_etag('report', current_user.id, rtype, start, end, data_version)
+        cached = not_modified(etag, last_modified)
+        if cached is not None:
+            return cached
+    version, total, pdf_bytes, pdf_file = build_report(current_user, rtype, start, end)
+    run_write(lambda: db.session.add(ReportLog(
+        user_id=current_user.id, report_type=rtype, total=total, start_date=start, end_date=end
+    )))
     if send_flag:
         to_email = data.get('email', current_user.email)
-        subject = f"تقرير المصاريف - {rtype}"
-        body = f"أرسل لك تقرير {rtype} للمصاريف من {start} إلى {end}. الإجمالي: {total:.2f} د.ج"
+        subject, body = report_email(rtype, start, end, total)
         try:
-            send_email_with_pdf(to_email, subject, body, pdf_buf, pdf_filename=f"report_{rtype}_{start}_{end}.pdf")
+            if pdf_file:
+                with pdf_file:
+                    send_email_with_pdf(to_email, subject, body, pdf_file, pdf_filename=filename)
+            else:
+                send_email_with_pdf(to_email, subject, body, BytesIO(pdf_bytes), pdf_filename=filename)
         except Exception as e:
             return jsonify({'message': 'report generated but email failed', 'error': str(e)}), 500
         return jsonify({'message': 'report generated and emailed', 'total': total})
-    return send_file(pdf_buf, as_attachment=True, download_name=f"report_{rtype}_{start}_{end}.pdf", mimetype='application/pdf')
+    if pdf_file:
+        resp = send_file(pdf_file, as_attachment=True, download_name=filename, mimetype='application/pdf', etag=False)
+    else:
+        resp = send_file(BytesIO(pdf_bytes), as_attachment=True, download_name=filename, mimetype='application/pdf', etag=False)
+    return with_validators(resp, etag, last_modified)
+
+@bp.route('/reports', methods=['POST'])
+@token_required
+def create_report_job(current_user):
+    # same body as /generate_report; answers 202 at once, the report is built by the job pool
+    data = request.json or {}
+    rtype = data.get('type', 'weekly')
+    if rtype not in ('weekly', 'monthly', 'custom'):
+        return jsonify({'message': 'type must be weekly, monthly or custom'}), 400
+    try:
+        start, end = report_window(rtype, data, date.today())
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    send_flag = bool(data.get('send_email', False))
+    email = data.get('email') if send_flag else None
+    data_version, _ = user_data_version(current_user.id)
+    key = report_job_key(current_user.id, rtype, start, end, send_flag, email, data_version)
+    existing = ReportJob.query.filter(ReportJob.dedup_key == key, ReportJob.status.in_(('queued', 'running'))).first()
+    if existing:
+        return jsonify(report_job_to_dict(existing)), 202
+    job = ReportJob(id=uuid.uuid4().hex, user_id=current_user.id, report_type=rtype, start_date=start,
+                    end_date=end, send_email=send_flag, email=email, dedup_key=key)
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # an identical request won the race
+        db.session.rollback()
+        existing = ReportJob.query.filter(ReportJob.dedup_key == key, ReportJob.status.in_(('queued', 'running'))).first()
+        if existing:
+            return jsonify(report_job_to_dict(existing)), 202
+        raise
+    try:
+        submit_report_job(current_app._get_current_object(), job.id)
+    except ReportQueueFull:
+        job.status, job.error, job.finished_at = 'failed', 'queue full', datetime.utcnow()
+        db.session.commit()
+        raise
+    return jsonify(report_job_to_dict(job)), 202
+
+@bp.route('/reports/<job_id>', methods=['GET'])
+@token_required
+def get_report_job(current_user, job_id):
+    # job status; with ?download=1 the finished PDF
+    job = db.session.get(ReportJob, job_id)
+    if job is None or job.user_id != current_user.id:
+        return jsonify({'message': 'report not found'}), 404
+    if not request.args.get('download'):
+        return jsonify(report_job_to_dict(job))
+    if job.status != 'done':
+        return jsonify({'message': f'report is {job.status}'}), 409
+    etag = make_etag('report-job', job.id, job.version)
+    cached = not_modified(etag, job.finished_at)
+    if cached is not None:
+        return cached
+    pdf_file = report_cache_get(job.user_id, job.report_type, job.start_date, job.end_date, job.version, read=False)
+    if pdf_file is None:
+        return jsonify({'message': 'report expired, request it again'}), 410
+    filename = f"report_{job.report_type}_{job.start_date}_{job.end_date}.pdf"
+    resp = send_file(pdf_file, as_attachment=True, download_name=filename, mimetype='application/pdf', etag=False)
+    return with_validators(resp, etag, job.finished_at)
 
 # -------------------- Admin routes for manager.py --------------------
 
-@app.route('/users', methods=['GET'])
+@bp.route('/users', methods=['GET'])
 def get_all_users_for_admin():
     admin_key = request.headers.get('X-Admin-Key')
     if admin_key != ADMIN_KEY:
         return jsonify({"error": "Unauthorized"}), 403
+    # every user change bumps its data_version, so (count, sum, max) identifies the listing
+    count, versions, last_modified = db.session.query(
+        db.func.count(User.id), db.func.coalesce(db.func.sum(User.data_version), 0), db.func.max(User.data_updated_at)
+    ).one()
+    etag = make_etag('users', count, versions, last_modified)
+    cached = not_modified(etag, last_modified)
+    if cached is not None:
+        return cached
     users = User.query.all()
-    return jsonify({u.email: u.password_hash for u in users})
+    return with_validators(jsonify({u.email: u.password_hash for u in users}), etag, last_modified)
+
+@bp.route('/password_pool_status', methods=['GET'])
+def password_pool_status():
+    admin_key = request.headers.get('X-Admin-Key')
+    if admin_key != ADMIN_KEY:
+        return jsonify({"error": "Unauthorized"}), 403
+    with _password_stats_lock:
+        stats = dict(password_pool_stats)
+    done = stats['completed'] or 1
+    stats['wait_seconds_avg'] = stats['wait_seconds_sum'] / done
+    stats['run_seconds_avg'] = stats['run_seconds_sum'] / done
+    stats['workers'] = PASSWORD_HASH_WORKERS
+    stats['max_queue'] = PASSWORD_HASH_MAX_QUEUE
+    return jsonify(stats)
 
-@app.route('/admin_reset_password', methods=['POST'])
+@bp.route('/admin_reset_password', methods=['POST'])
 def admin_reset_password():
     data = request.json
     if data.get('admin_key') != ADMIN_KEY:
@@ -268,66 +2441,580 @@ def admin_reset_password():
     if not user:
         return jsonify({"error": "User not found"}), 404
     user.set_password(new_password)
+    for column, value in data_version_bump().items():
+        setattr(user, column, value)
     db.session.commit()
+    invalidate_user_cache(user.id)
     return jsonify({"message": "Password reset successfully"}), 200
 
 # -------------------- Scheduler --------------------
 
-def make_and_send_reports():
-    users = User.query.all()
-    today = date.today()
-    for user in users:
+def report_windows(today: date):
+    # [(report_type, start, end)] due today: weekly every day, monthly on the last day of the month
+    windows = [('weekly', today - timedelta(days=7), today)]
+    if (today + timedelta(days=1)).day == 1:
+        windows.append(('monthly', date(today.year, today.month, 1), today))
+    return windows
+
+def queue_user_report(user, rtype, start, end, pdf_bytes, total):
+    # (outbox row, ReportLog) of one scheduled report, both under the report's idempotency key
+    label = 'أسبوعي' if rtype == 'weekly' else 'شهري'
+    key = report_idempotency_key(user.id, rtype, start, end)
+    email = {
+        'to_email': user.email,
+        'subject': f"تقرير {label} للمصاريف ({start} — {end})",
+        'body': f"سلام، هذا تقرير المصاريف ال{label} للمستخدم {user.name}. الإجمالي: {total:.2f} د.ج",
+        'attachment': pdf_bytes,
+        'attachment_name': f"{rtype}_{user.id}_{start}_{end}.pdf",
+        'idempotency_key': key,
+    }
+    return email, ReportLog(user_id=user.id, report_type=rtype, total=total, start_date=start, end_date=end,
+                            idempotency_key=key)
+
+def report_idempotency_key(user_id, rtype, start, end):
+    return f"{user_id}:{rtype}:{start}:{end}"
+
+def report_job_idempotency_key(job_id):
+    # a job may run again after a crash; its email and ReportLog must not
+    return f"job:{job_id}"
+
+def reports_already_sent(windows):
+    # {(user_id, report_type)} already logged by the scheduler for these periods
+    done = set()
+    for rtype, start, end in windows:
+        done.update((user_id, rtype) for user_id, in db.session.query(ReportLog.user_id).filter(
+            ReportLog.idempotency_key.isnot(None),
+            ReportLog.report_type == rtype,
+            ReportLog.start_date == start,
+            ReportLog.end_date == end
+        ))
+    return done
+
+def report_window_query(start: date, end: date):
+    # every user's purchases in [start, end], ordered for groupby(user_id)
+    return db.session.query(
+        Purchase.user_id, User.name, User.email, Purchase.id,
+        Purchase.item_name, Purchase.price_dz, Purchase.category, Purchase.date
+    ).join(User, User.id == Purchase.user_id).filter(
+        Purchase.date >= datetime.combine(start, datetime.min.time()),
+        Purchase.date <= datetime.combine(end, datetime.max.time())
+    ).order_by(Purchase.user_id, Purchase.date)
+
+def make_and_send_reports(today=None):
+    """Build and email the due reports for every user with purchases in the window.
+
+    All purchases of the reporting window are read with one query ordered by
+    user_id and streamed in batches; users without activity are never loaded.
+    Reports whose idempotency key is already in ReportLog are not rebuilt. The
+    outbox emails commit before their ReportLog rows under the same key, and
+    the outbox ignores a key it already holds, so a rerun of the same day never
+    sends a report twice. With SHARDS set, the main database and every shard
+    are processed in parallel. Returns the run statistics.
+    """
+    started = time.monotonic()
+    started_at = datetime.utcnow()
+    today = today or date.today()
+    windows = report_windows(today)
+
+    stats = {'processed': 0, 'skipped': 0, 'failed': 0, 'reports_queued': 0, 'already_sent': 0}
+    for _, location_stats in for_each_location(lambda: send_location_reports(today, windows)):
+        for stat, value in location_stats.items():
+            stats[stat] += value
+    stats['skipped'] = User.query.count() - stats['processed'] - stats['failed']
+    stats['started_at'] = started_at.isoformat()
+    stats['duration_s'] = round(time.monotonic() - started, 3)
+    for stat in ('processed', 'skipped', 'failed', 'reports_queued', 'already_sent', 'duration_s'):
+        REPORT_JOB_LAST.set(stats[stat], stat=stat)
+    print(f"Reports run: {stats}")
+    return stats
+
+def send_location_reports(today, windows):
+    # make_and_send_reports for the users stored in the current database (main or one shard)
+    window_start = min(w[1] for w in windows)
+    rows = report_window_query(window_start, today).yield_per(STREAM_BATCH_SIZE)
+
+    stats = {'processed': 0, 'failed': 0, 'reports_queued': 0, 'already_sent': 0}
+    done = reports_already_sent(windows)
+    emails = []
+    logs = []
+    active = set()
+    failed = set()
+    pending = deque()
+
+    def finish(item):
+        user, rtype, start, end, version, fut = item
         try:
-            # Weekly report (last 7 days)
-            start = today - timedelta(days=7)
-            end = today
-            purchases = Purchase.query.filter(
-                Purchase.user_id == user.id,
-                Purchase.date >= datetime.combine(start, datetime.min.time()),
-                Purchase.date <= datetime.combine(end, datetime.max.time())
-            ).all()
-            if purchases:
-                pdf_buf, total = generate_pdf_report(user, purchases, title=f"تقرير أسبوعي من {start} إلى {end}")
-                subject = f"تقرير أسبوعي للمصاريف ({start} — {end})"
-                body = f"سلام، هذا تقرير المصاريف الأسبوعي للمستخدم {user.name}. الإجمالي: {total:.2f} د.ج"
-                send_email_with_pdf(user.email, subject, body, pdf_buf, pdf_filename=f"weekly_{user.id}_{start}_{end}.pdf")
-                db.session.add(ReportLog(user_id=user.id, report_type='weekly', total=total, start_date=start, end_date=end))
-                db.session.commit()
+            pdf_bytes, total = fut.result()
+            report_cache_put(user.id, rtype, start, end, version, pdf_bytes)
+            email, log = queue_user_report(user, rtype, start, end, pdf_bytes, total)
+            emails.append(email)
+            logs.append(log)
+            stats['reports_queued'] += 1
         except Exception as e:
-            print(f"Weekly report error for {user.email}: {e}")
+            failed.add(user.id)
+            print(f"{rtype.capitalize()} report error for {user.email}: {e}")
+
+    # renders run in the process pool while this thread streams rows and queues emails
+    for user_id, group in groupby(rows, key=lambda r: r.user_id):
+        purchases = list(group)
+        user = ReportUser(user_id, purchases[0].name, purchases[0].email)
+        active.add(user_id)
+        for rtype, start, end in windows:
+            in_window = [p for p in purchases if start <= p.date.date() <= end]
+            if not in_window:
+                continue
+            if (user_id, rtype) in done:
+                stats['already_sent'] += 1
+                continue
+            total = sum(p.price_dz for p in in_window)
+            version = purchase_set_version(len(in_window), total, max(p.id for p in in_window))
+            cached = report_cache_get(user_id, rtype, start, end, version)
+            if cached is not None:
+                fut = Future()
+                fut.set_result((cached, total))
+            else:
+                fut = submit_report_render(user, in_window, report_title(rtype, start, end))
+            pending.append((user, rtype, start, end, version, fut))
+            while len(pending) > REPORT_MAX_IN_FLIGHT:
+                finish(pending.popleft())
+    while pending:
+        finish(pending.popleft())
+    stats['failed'] = len(failed)
+    stats['processed'] = len(active) - len(failed)
 
-    # Monthly report on last day of month
-    next_day = today + timedelta(days=1)
-    if next_day.day == 1:
-        for user in users:
+    # written once the cursor is exhausted. The outbox is in the main database and the
+    # ReportLog here, with no two-phase commit between them: the emails commit first, so a
+    # crash before the logs commit only makes the rerun queue the same keys again, which
+    # the outbox skips
+    if emails:
+        db.session.execute(sqlite_insert(EmailOutbox).on_conflict_do_nothing(index_elements=['idempotency_key']), emails)
+        db.session.commit()
+    db.session.add_all(logs)
+    db.session.commit()
+    return stats
+
+def acquire_scheduler_lease(name='scheduler'):
+    """Take or renew the leader lease; True if this process is the leader.
+
+    One upsert: it inserts the lease, or takes it over only if we already
+    hold it or it has expired. Works across gunicorn workers and hosts.
+    """
+    now = datetime.utcnow()
+    stmt = sqlite_insert(SchedulerLease).values(
+        name=name, holder=SCHEDULER_INSTANCE_ID, expires_at=now + SCHEDULER_LEASE_TTL
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['name'],
+        set_={'holder': stmt.excluded.holder, 'expires_at': stmt.excluded.expires_at},
+        where=db.or_(SchedulerLease.holder == SCHEDULER_INSTANCE_ID, SchedulerLease.expires_at < now)
+    )
+    db.session.execute(stmt)
+    db.session.commit()
+    holder = db.session.query(SchedulerLease.holder).filter_by(name=name).scalar()
+    return holder == SCHEDULER_INSTANCE_ID
+
+def job_due_today(name, today=None):
+    run = db.session.get(JobRun, name)
+    return run is None or run.last_success_at is None or run.last_success_at.date() < (today or date.today())
+
+def run_leader_job(app, name, fn, daily=False):
+    """Run `fn` only on the lease holder, recording the run in JobRun.
+
+    Daily jobs are polled often but run once per day: after a restart or a
+    leader change they pick up from the stored last_success_at.
+    """
+    with app.app_context():
+        try:
+            if not acquire_scheduler_lease():
+                return
+            if daily and not job_due_today(name):
+                return
+            run = db.session.get(JobRun, name) or JobRun(name=name)
+            run.last_started_at = datetime.utcnow()
+            db.session.add(run)
+            db.session.commit()
+            started = time.perf_counter()
             try:
-                first = date(today.year, today.month, 1)
-                last = today
-                purchases = Purchase.query.filter(
-                    Purchase.user_id == user.id,
-                    Purchase.date >= datetime.combine(first, datetime.min.time()),
-                    Purchase.date <= datetime.combine(last, datetime.max.time())
-                ).all()
-                if purchases:
-                    pdf_buf, total = generate_pdf_report(user, purchases, title=f"تقرير شهري من {first} إلى {last}")
-                    subject = f"تقرير شهري للمصاريف ({first} — {last})"
-                    body = f"سلام، هذا تقرير المصاريف الشهري للمستخدم {user.name}. الإجمالي: {total:.2f} د.ج"
-                    send_email_with_pdf(user.email, subject, body, pdf_buf, pdf_filename=f"monthly_{user.id}_{first}_{last}.pdf")
-                    db.session.add(ReportLog(user_id=user.id, report_type='monthly', total=total, start_date=first, end_date=last))
-                    db.session.commit()
+                result = fn()
             except Exception as e:
-                print(f"Monthly report error for {user.email}: {e}")
+                JOB_SECONDS.observe(time.perf_counter() - started, job=name)
+                JOB_RUNS.inc(job=name, status='error')
+                db.session.rollback()
+                run = db.session.get(JobRun, name)
+                run.last_error = f"{datetime.utcnow().isoformat()} {e}"
+                db.session.commit()
+                print(f"Job {name} failed: {e}")
+                return
+            JOB_SECONDS.observe(time.perf_counter() - started, job=name)
+            JOB_RUNS.inc(job=name, status='ok')
+            run = db.session.get(JobRun, name)
+            run.last_success_at = datetime.utcnow()
+            run.last_error = None
+            if result is not None:
+                run.last_stats = json.dumps(result, default=str)
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+def run_reports_job(app):
+    run_leader_job(app, 'reports', make_and_send_reports, daily=True)
+    run_outbox_job(app)
+
+def run_outbox_job(app):
+    run_leader_job(app, 'outbox', deliver_outbox)
+
+def run_report_jobs_sweep(app):
+    run_leader_job(app, 'report_jobs', lambda: resume_report_jobs(app))
+
+def run_balance_snapshot_job(app):
+    run_leader_job(app, 'balance_snapshot', lambda: sum(n for _, n in for_each_location(snapshot_balances)), daily=True)
+
+def run_archive_job(app):
+    run_leader_job(app, 'archive', archive_all_purchases, daily=True)
+
+def run_lease_heartbeat(app):
+    # keeps the lease alive between jobs so leadership doesn't flap
+    with app.app_context():
+        try:
+            acquire_scheduler_lease()
+        finally:
+            db.session.remove()
+
+@bp.route('/scheduler_status', methods=['GET'])
+def scheduler_status():
+    admin_key = request.headers.get('X-Admin-Key')
+    if admin_key != ADMIN_KEY:
+        return jsonify({"error": "Unauthorized"}), 403
+    lease = db.session.get(SchedulerLease, 'scheduler')
+    return jsonify({
+        'instance': SCHEDULER_INSTANCE_ID,
+        'leader': lease.holder if lease and lease.expires_at > datetime.utcnow() else None,
+        'jobs': {r.name: {
+            'last_started_at': r.last_started_at and r.last_started_at.isoformat(),
+            'last_success_at': r.last_success_at and r.last_success_at.isoformat(),
+            'last_error': r.last_error,
+            'last_stats': json.loads(r.last_stats) if r.last_stats else None,
+        } for r in JobRun.query.all()}
+    })
+
+def start_scheduler(app):
+    """Start the background jobs for `app`; returns the running scheduler.
+
+    Any number of processes may call this: only the lease holder runs the jobs.
+    """
+    from apscheduler.schedulers.background import BackgroundScheduler
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(func=run_lease_heartbeat, args=(app,), trigger="interval", seconds=SCHEDULER_LEASE_TTL.total_seconds() / 3)
+    scheduler.add_job(func=run_reports_job, args=(app,), trigger="interval", hours=1)
+    scheduler.add_job(func=run_outbox_job, args=(app,), trigger="interval", minutes=OUTBOX_POLL_MINUTES)
+    scheduler.add_job(func=run_balance_snapshot_job, args=(app,), trigger="interval", hours=1)
+    scheduler.add_job(func=run_archive_job, args=(app,), trigger="interval", hours=1)
+    scheduler.add_job(func=run_report_jobs_sweep, args=(app,), trigger="interval", minutes=OUTBOX_POLL_MINUTES)
+    scheduler.start()
+    return scheduler
+
+@bp.cli.command('run-scheduler')
+def run_scheduler_command():
+    """Run the scheduled jobs in this process until interrupted."""
+    scheduler = start_scheduler(current_app._get_current_object())
+    print(f"Scheduler running as {SCHEDULER_INSTANCE_ID}")
+    try:
+        while True:
+            time.sleep(3600)
+    except (KeyboardInterrupt, SystemExit):
+        scheduler.shutdown()
+
+# -------------------- Migrations --------------------
+# كل ترحيل: (رقم النسخة، الوصف، أوامر SQL أو دوال تأخذ الاتصال). النسخة الحالية محفوظة في PRAGMA user_version.
+# create_all() لا يضيف فهارس أو أعمدة للجداول الموجودة، لذلك تمر التغييرات من هنا.
+def add_column(table, column, ddl):
+    # ALTER TABLE step that is skipped when create_all() already built the column
+    def step(conn):
+        columns = [r[1] for r in conn.exec_driver_sql(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            conn.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}')
+    return step
+
+# فهرس FTS5 للبحث في أسماء المشتريات وفئاتها؛ بلا محتوى (content='') لأن البحث يعيد rowid فقط،
+# والعمود owner يحمل u<user_id> حتى يُقيَّد البحث بمستخدم واحد داخل الفهرس نفسه
+PURCHASE_FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS purchase_fts USING fts5("
+    "item_name, category, owner, content='', prefix='2 3', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS purchase_fts_ai AFTER INSERT ON purchase BEGIN "
+    "INSERT INTO purchase_fts (rowid, item_name, category, owner) "
+    "VALUES (new.id, new.item_name, coalesce(new.category, ''), 'u' || new.user_id); END",
+    "CREATE TRIGGER IF NOT EXISTS purchase_fts_ad AFTER DELETE ON purchase BEGIN "
+    "INSERT INTO purchase_fts (purchase_fts, rowid, item_name, category, owner) "
+    "VALUES ('delete', old.id, old.item_name, coalesce(old.category, ''), 'u' || old.user_id); END",
+    "CREATE TRIGGER IF NOT EXISTS purchase_fts_au AFTER UPDATE OF item_name, category, user_id ON purchase BEGIN "
+    "INSERT INTO purchase_fts (purchase_fts, rowid, item_name, category, owner) "
+    "VALUES ('delete', old.id, old.item_name, coalesce(old.category, ''), 'u' || old.user_id); "
+    "INSERT INTO purchase_fts (rowid, item_name, category, owner) "
+    "VALUES (new.id, new.item_name, coalesce(new.category, ''), 'u' || new.user_id); END",
+]
+
+MIGRATIONS = [
+    (1, 'index purchase(user_id, date) and report_log(user_id, sent_at)', [
+        'CREATE INDEX IF NOT EXISTS ix_purchase_user_date ON purchase (user_id, date)',
+        'CREATE INDEX IF NOT EXISTS ix_report_log_user_sent ON report_log (user_id, sent_at)',
+    ]),
+    (2, 'backfill daily_category_total from purchase', [
+        # the table itself is created by create_all()
+        'DELETE FROM daily_category_total',
+        "INSERT INTO daily_category_total (user_id, day, category, total_dz, count) "
+        "SELECT user_id, date(date), coalesce(category, ''), sum(price_dz), count(*) "
+        "FROM purchase GROUP BY user_id, date(date), coalesce(category, '')",
+    ]),
+    (3, 'index purchase(date) for the set-based scheduler query', [
+        'CREATE INDEX IF NOT EXISTS ix_purchase_date ON purchase (date)',
+    ]),
+    (4, 'open the balance ledger with each user\'s current balance', [
+        # tables are created by create_all(); existing balances become opening entries
+        "INSERT INTO balance_ledger (user_id, amount, reason, created_at) "
+        "SELECT id, coalesce(balance_dz, 0), 'opening', datetime('now') FROM user",
+    ]),
+    (5, 'idempotency key on report_log', [
+        add_column('report_log', 'idempotency_key', 'VARCHAR(80)'),
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_report_log_idempotency_key ON report_log (idempotency_key)',
+    ]),
+    (6, 'per-user data version for ETag / Last-Modified', [
+        add_column('user', 'data_version', 'INTEGER NOT NULL DEFAULT 0'),
+        add_column('user', 'data_updated_at', 'DATETIME'),
+        "UPDATE user SET data_updated_at = datetime('now') WHERE data_updated_at IS NULL",
+    ]),
+    (7, 'full-text index purchase_fts over item_name and category', PURCHASE_FTS_SCHEMA + [
+        "INSERT INTO purchase_fts (rowid, item_name, category, owner) "
+        "SELECT id, item_name, coalesce(category, ''), 'u' || user_id FROM purchase",
+    ]),
+    (8, 'idempotency key on email_outbox', [
+        add_column('email_outbox', 'idempotency_key', 'VARCHAR(80)'),
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_email_outbox_idempotency_key ON email_outbox (idempotency_key)',
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn):
+    return conn.exec_driver_sql('PRAGMA user_version').scalar()
+
+def migrate_db(engine=None):
+    """Apply pending migrations in order (main database by default); returns the applied versions."""
+    applied = []
+    with (engine or db.engine).begin() as conn:
+        current = get_schema_version(conn)
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            for stmt in statements:
+                if callable(stmt):
+                    stmt(conn)
+                else:
+                    conn.exec_driver_sql(stmt)
+            conn.exec_driver_sql(f'PRAGMA user_version = {int(version)}')
+            applied.append(version)
+            print(f"Applied migration {version}: {description}")
+    return applied
+
+def init_database(engine):
+    fresh = not db.inspect(engine).has_table(User.__tablename__)
+    # every database gets the full schema; a shard simply leaves the main-only tables empty
+    db.metadata.create_all(engine)
+    if fresh:
+        # new database: create_all() already built the latest schema, except for the FTS index
+        with engine.begin() as conn:
+            for stmt in PURCHASE_FTS_SCHEMA:
+                conn.exec_driver_sql(stmt)
+            conn.exec_driver_sql(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        return []
+    return migrate_db(engine)
+
+def init_id_spaces():
+    """Give the main database and every shard its IdSpace row, once.
+
+    A new row's floor is the highest id in use in any database, so ids written
+    before (e.g. before SHARDS was set) are never handed out again.
+    """
+    tables = [t for t in IdSpace.__table__.metadata.sorted_tables
+              if t.name in SHARDED_TABLES and 'id' in t.c]
+    top = 0
+    for location in shard_locations():
+        with location_engine(location).connect() as conn:
+            for table in tables:
+                top = max(top, conn.execute(db.select(db.func.max(table.c.id))).scalar() or 0)
+    for location in shard_locations():
+        with location_engine(location).begin() as conn:
+            conn.execute(sqlite_insert(IdSpace).values(
+                location=0 if location is None else location + 1, floor=top
+            ).on_conflict_do_nothing(index_elements=['location']))
+
+def init_db():
+    # main database first, then each shard; returns the migrations applied to the main database
+    applied = init_database(db.engine)
+    for n in range(SHARD_COUNT):
+        init_database(db.engines[f'shard{n}'])
+    if SHARD_COUNT:
+        init_id_spaces()
+    return applied
+
+def explain_hot_queries():
+    """EXPLAIN QUERY PLAN of the hot per-user queries: {name: [plan detail, ...]}."""
+    today = date.today()
+    newest_first = (Purchase.date.desc(), Purchase.id.desc())
+    cursor = (datetime.utcnow(), 0)
+    queries = {
+        'get_purchases': db.session.query(*PURCHASE_COLUMNS).filter(
+            Purchase.user_id == 0, Purchase.date >= datetime.utcnow()
+        ).order_by(*newest_first),
+        # the next-page queries exactly as /purchases and /purchases/search run them
+        'get_purchases_page': keyset_after(
+            db.session.query(*PURCHASE_COLUMNS).filter(Purchase.user_id == 0).order_by(*newest_first), cursor
+        ).limit(PURCHASES_PAGE_SIZE + 1),
+        'search_purchases_page': keyset_after(
+            search_query(0, fts_match('x', 0)).order_by(*newest_first), cursor
+        ).limit(PURCHASES_PAGE_SIZE + 1),
+        'generate_report': purchases_in_range(0, today, today).order_by(Purchase.date),
+        'make_and_send_reports': report_window_query(today - timedelta(days=7), today),
+        'report_log': ReportLog.query.filter(
+            ReportLog.user_id == 0, ReportLog.sent_at >= datetime.utcnow()
+        ),
+    }
+    plans = {}
+    conn = db.session.connection()
+    for name, q in queries.items():
+        compiled = q.statement.compile(dialect=db.engine.dialect)
+        params = [None] * len(compiled.positiontup or ())
+        rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), tuple(params)).fetchall()
+        plans[name] = [r[-1] for r in rows]
+    return plans
+
+# index seeks a hot query must keep: the keyset pages have to bound `date` in the index,
+# otherwise SQLite walks all of the user's rows down to the cursor
+HOT_QUERY_SEEKS = {
+    'get_purchases_page': 'ix_purchase_user_date (user_id=? AND date<?)',
+    'search_purchases_page': 'ix_purchase_user_date (user_id=? AND date<?)',
+}
+
+def check_query_plans():
+    # [(name, ok, plan)]: ok = served by an index, no full scan, and the expected seek if any
+    results = []
+    for name, plan in explain_hot_queries().items():
+        ok = any('USING INDEX' in d or 'USING COVERING INDEX' in d for d in plan) \
+            and not any(d.startswith('SCAN') and 'INDEX' not in d for d in plan) \
+            and (name not in HOT_QUERY_SEEKS or any(HOT_QUERY_SEEKS[name] in d for d in plan))
+        results.append((name, ok, plan))
+    return results
+
+@bp.cli.command('migrate')
+def migrate_command():
+    """Create missing tables and apply pending schema migrations."""
+    applied = init_db()
+    print(f"Schema version {SCHEMA_VERSION} ({len(applied)} migration(s) applied)")
+
+@bp.cli.command('reconcile-balances')
+def reconcile_balances_command():
+    """Compare user balances with the ledger; exit 1 on any mismatch."""
+    taken = sum(n for _, n in for_each_location(snapshot_balances))
+    mismatches = [m for _, found in for_each_location(reconcile_balances) for m in found]
+    for user_id, stored, ledger in mismatches:
+        print(f"user {user_id}: balance_dz={stored} ledger={ledger:.2f}")
+    print(f"{taken} snapshot(s) taken, {len(mismatches)} mismatch(es)")
+    if mismatches:
+        raise SystemExit(1)
+
+@bp.cli.command('check-indexes')
+def check_indexes_command():
+    """Fail if a hot query falls back to a full table scan."""
+    failed = False
+    for name, ok, plan in check_query_plans():
+        failed = failed or not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {name}: {' / '.join(plan)}")
+    if failed:
+        raise SystemExit(1)
+
+@bp.cli.command('archive-purchases')
+def archive_purchases_command():
+    """Move purchases older than ARCHIVE_AFTER_MONTHS months to the compressed archive."""
+    if ARCHIVE_AFTER_MONTHS <= 0:
+        raise SystemExit('ARCHIVE_AFTER_MONTHS is 0: archiving is off')
+    archive_all_purchases()
+
+@bp.cli.command('rebalance-shards')
+@click.option('--dry-run', is_flag=True, help='only list the moves')
+def rebalance_shards_command(dry_run):
+    """Move every user whose data is not on its hash shard (including users still in main)."""
+    if not SHARD_COUNT:
+        raise SystemExit('SHARDS is not set')
+    placed = dict(db.session.query(ShardMap.user_id, ShardMap.shard).all())
+    moves = [(user_id, placed.get(user_id), target_shard(user_id))
+             for user_id, in db.session.query(User.id).order_by(User.id)
+             if placed.get(user_id) != target_shard(user_id)]
+    for user_id, source, target in moves:
+        if dry_run:
+            print(f"user {user_id}: {'main' if source is None else source} -> {target}")
+            continue
+        copied = move_user_data(user_id, target)
+        invalidate_user_cache(user_id)
+        print(f"user {user_id}: {'main' if source is None else source} -> {target} ({copied} rows)")
+    print(f"{len(moves)} user(s) {'to move' if dry_run else 'moved'}")
+
+@bp.cli.command('move-user')
+@click.argument('user_id', type=int)
+@click.argument('target')
+def move_user_command(user_id, target):
+    """Move one user's data to a shard number, or back to 'main'."""
+    target = None if target == 'main' else int(target)
+    if target is not None and not 0 <= target < SHARD_COUNT:
+        raise SystemExit(f"no shard {target} (SHARDS={SHARD_COUNT})")
+    copied = move_user_data(user_id, target)
+    invalidate_user_cache(user_id)
+    print(f"user {user_id}: {copied} rows moved to {'main' if target is None else f'shard {target}'}")
+
+# -------------------- App factory --------------------
+def create_app(config=None):
+    """Build the Flask app. Nothing runs at import time; with the defaults this only wires config.
+
+    config keys (defaults from the environment): SQLALCHEMY_DATABASE_URI,
+    INIT_DB (create tables / migrate now, instead of `flask migrate`),
+    SCHEDULER_ENABLED (start the background jobs in this process).
+    With SHARDS=N the shard databases are added as binds shard0 .. shardN-1.
+    """
+    if SHARD_COUNT >= ID_STRIDE:
+        raise RuntimeError(f'SHARDS must be below {ID_STRIDE} (ID_STRIDE)')
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_BINDS'] = {f'shard{n}': SHARD_URL.format(n=n) for n in range(SHARD_COUNT)}
+    app.config['INIT_DB'] = INIT_DB
+    app.config['SCHEDULER_ENABLED'] = SCHEDULER_ENABLED
+    app.config.update(config or {})
+    if SQLITE_TUNING and app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {
+            # connections are shared between request, scheduler and writer threads
+            'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000, 'check_same_thread': False},
+            'pool_size': SQLITE_POOL_SIZE,
+            'max_overflow': SQLITE_POOL_SIZE,
+            'pool_timeout': 30,
+        })
+    db.init_app(app)
+    app.register_blueprint(bp)
+    if app.config['INIT_DB']:
+        with app.app_context():
+            init_db()
+    if app.config['SCHEDULER_ENABLED']:
+        app.extensions['scheduler'] = start_scheduler(app)
+    return app
 
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=make_and_send_reports, trigger="interval", hours=24)
-scheduler.start()
+_default_app = None
 
-# -------------------- Init DB --------------------
-@app.before_first_request
-def create_tables():
-    db.create_all()
+def __getattr__(name):
+    # `server:app` / `from server import app` still work: the default app is built on first access
+    global _default_app
+    if name != 'app':
+        raise AttributeError(name)
+    if _default_app is None:
+        _default_app = create_app()
+    return _default_app
 
 # -------------------- Run --------------------
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
+    create_app({'INIT_DB': True}).run(host='0.0.0.0', port=port)
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = server.create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'budget.db'}",
+        'INIT_DB': True,
+    })
+    with app.app_context():
+        yield app
+        server.db.session.remove()
+        for engine in server.db.engines.values():
+            engine.dispose()
@@ -0,0 +1,35 @@
+import re
+import zlib
+from io import BytesIO
+
+from pdf_report import render_report_pdf, render_report_to
+
+
+def report_rows(n):
+    return (('2024-01-%02d' % (i % 28 + 1), 'food' if i % 3 else None, f'item {i} (خبز)', 1.5) for i in range(n))
+
+
+def test_streamed_report_is_a_well_formed_pdf():
+    out = BytesIO()
+    total = render_report_to(out, 'Ali', 'ali@example.com', report_rows(500), 'title')
+    pdf = out.getvalue()
+    assert total == 750.0
+    assert pdf.startswith(b'%PDF-1.4') and pdf.endswith(b'%%EOF\n')
+    # every xref entry points at its object
+    xref = int(re.search(rb'startxref\n(\d+)', pdf).group(1))
+    lines = pdf[xref:].split(b'\n')
+    size = int(lines[1].split()[1])
+    for obj_id in range(1, size):
+        offset = int(lines[2 + obj_id][:10])
+        assert pdf[offset:].startswith(b'%d 0 obj' % obj_id)
+    pages = [zlib.decompress(m.group(1)) for m in re.finditer(rb'stream\n(.*?)\nendstream', pdf, re.S)]
+    assert b'item 499 \\() Tj' in pages[-1]
+    assert b'(: 750.00 ) Tj' in pages[-1]
+
+
+def test_streamed_report_has_the_same_pages_as_the_in_memory_one():
+    streamed = BytesIO()
+    render_report_to(streamed, 'Ali', 'ali@example.com', report_rows(500), 'title')
+    pdf_bytes, _ = render_report_pdf('Ali', 'ali@example.com', list(report_rows(500)), 'title')
+    count = re.compile(rb'/Count (\d+)')
+    assert count.search(streamed.getvalue()).group(1) == count.search(pdf_bytes).group(1)
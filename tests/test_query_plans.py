@@ -0,0 +1,14 @@
+# EXPLAIN QUERY PLAN regression test: the hot per-user queries must stay on their indexes
+import server
+
+
+def test_hot_queries_use_indexes(app):
+    failures = {name: plan for name, ok, plan in server.check_query_plans() if not ok}
+    assert not failures
+
+
+def test_keyset_page_seeks_by_date(app):
+    # without the date bound the page query only seeks on user_id, and deep pages scan
+    plans = server.explain_hot_queries()
+    for name in ('get_purchases_page', 'search_purchases_page'):
+        assert any('(user_id=? AND date<?)' in d for d in plans[name]), plans[name]
@@ -0,0 +1,103 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import server
+from server import BalanceLedger, BalanceSnapshot, Purchase, db
+
+
+@pytest.fixture
+def sharded_app(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'SHARD_COUNT', 2)
+    monkeypatch.setattr(server, 'SHARD_URL', f"sqlite:///{tmp_path}/shard{{n}}.db")
+    monkeypatch.setattr(server, 'ARCHIVE_AFTER_MONTHS', 12)
+    app = server.create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'budget.db'}",
+        'INIT_DB': True,
+    })
+    with app.app_context():
+        yield app
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def add_user(client, email, purchases):
+    client.post('/register', json={'email': email, 'password': 'pw', 'balance_dz': 1000})
+    login = client.post('/login', json={'email': email, 'password': 'pw'}).json
+    headers = {'Authorization': 'Bearer ' + login['token']}
+    assert client.post('/add_purchases', headers=headers, json={'purchases': purchases}).status_code == 200
+    return login['user']['id'], headers
+
+
+def user_state(client, user_id, headers):
+    # everything a move must carry over unchanged: ids, contents and the balance history
+    with server.user_shard(user_id):
+        ledger = db.session.query(BalanceLedger.id, BalanceLedger.amount, BalanceLedger.purchase_id).filter(
+            BalanceLedger.user_id == user_id).order_by(BalanceLedger.id).all()
+        snapshots = db.session.query(BalanceSnapshot.id, BalanceSnapshot.ledger_id).filter(
+            BalanceSnapshot.user_id == user_id).all()
+        balance_at = server.balance_at(user_id, datetime.utcnow())
+        db.session.commit()
+    return {
+        'purchases': client.get('/purchases', headers=headers).json,
+        'ledger': ledger,
+        'snapshots': snapshots,
+        'balance': client.get('/balance', headers=headers).json['balance_dz'],
+        'balance_at': balance_at,
+    }
+
+
+def test_move_keeps_ids_archive_and_balance_history(sharded_app):
+    client = sharded_app.test_client()
+    old = (date.today() - timedelta(days=800)).isoformat()
+    today = date.today().isoformat()
+    user_id, headers = add_user(client, 'a@example.com', [
+        {'item_name': 'old', 'price_dz': 10, 'date': old},
+        {'item_name': 'older', 'price_dz': 20, 'date': old},
+        {'item_name': 'new', 'price_dz': 30, 'date': today},
+    ])
+    assert server.archive_all_purchases()['purchases'] == 2
+    server.for_each_location(server.snapshot_balances)
+    source = server.shard_for_user(user_id)
+    before = user_state(client, user_id, headers)
+    page = client.get('/purchases?limit=1', headers=headers).json
+
+    for target in (1 - source, None, source):
+        server.move_user_data(user_id, target)
+        server.invalidate_user_cache(user_id)
+        assert server.shard_for_user(user_id) == target
+        assert user_state(client, user_id, headers) == before
+        # a cursor handed out before the move still continues the same listing
+        rest = client.get(f"/purchases?limit=5&cursor={page['next_cursor']}", headers=headers).json
+        assert [p['id'] for p in rest['purchases']] == [p['id'] for p in before['purchases'][1:]]
+
+    # new rows on the user's shard come after everything that moved
+    client.post('/add_purchase', headers=headers, json={'item_name': 'later', 'price_dz': 5, 'date': today})
+    later = client.get('/purchases?limit=1', headers=headers).json['purchases'][0]
+    assert later['id'] > max(p['id'] for p in before['purchases'])
+    assert later['id'] % server.ID_STRIDE == source + 1
+
+
+def test_ids_never_clash_between_databases(sharded_app):
+    client = sharded_app.test_client()
+    users = {}
+    for n in range(6):
+        user_id, headers = add_user(client, f'u{n}@example.com', [
+            {'item_name': f'item{n}-{i}', 'price_dz': 1, 'date': date.today().isoformat()} for i in range(3)
+        ])
+        users[user_id] = headers
+    shards = {server.shard_for_user(user_id) for user_id in users}
+    assert shards == {0, 1}
+    # every user through both shards and main: no id is taken twice anywhere
+    for target in (0, 1, None):
+        for user_id in users:
+            server.move_user_data(user_id, target)
+            server.invalidate_user_cache(user_id)
+    ids = []
+    for location in server.shard_locations():
+        with server.use_shard(location):
+            ids += [i for i, in db.session.query(Purchase.id)]
+            db.session.commit()
+    assert len(ids) == len(set(ids)) == 18